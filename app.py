@@ -1,18 +1,22 @@
+import functools
 import logging
 import os
 import subprocess
 import threading
 import time
-from collections import deque, defaultdict
 
-import docker
-import psutil
-import requests  # to make external HTTP requests
 from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
 from flask_restx import Api, Resource, fields
 
-from common.common import calculate_uptime, system_start_time, parse_status_file
+from common import archive, collectors, db, docker_client, docker_disk, hls, timing
+from common.common import calculate_uptime, convert_size, system_start_time, parse_status_file
+from common.docker_inventory import inventory
+from common.env_file import update_env
+from common.processes import SORT_KEYS, process_sampler
+from common.projects import ProjectStatus
+from common.restream import restreams
+from common.self_monitor import SelfMonitor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -27,13 +31,28 @@ api = Api(app, version='2.6', title='System Monitoring API',
 # Enable CORS for all routes and origins
 CORS(app)
 
-client = docker.from_env()
+# Per request phase timings (Server-Timing header, /monitor/debug/timings) and the ?profile=1 sampler
+timing.init_app(app)
+
 home = "/home/redbull"
 system_type = os.getenv('SYSTEM_TYPE', 'Main Server')
 instance_type = os.getenv('INSTANCE_TYPE', 'EC2_UBUNTU')
 
 vpn_container_name = 'gluetun'
 
+projects = ProjectStatus(f"{home}/GIT")
+
+# Short service names accepted by /restart and /stop
+service_containers = {'db': 'mariadb', 'redis': 'redis'}
+
+# Resource usage of the API process itself, checked on every tick of the embedded collectors
+app_monitor = SelfMonitor(base_interval=float(os.getenv('MONITOR_INTERVAL', '2')))
+
+# Collectors needing the container's view of the host (the /host_fs mounts, the Docker socket),
+# the host side ones run in network_monitor.py
+app_collectors = collectors.Scheduler(collectors.create(os.getenv('APP_COLLECTORS', 'disk,docker').split(',')),
+                                      app_monitor)
+
 ns = api.namespace('monitor', description='Monitoring operations')
 
 # Define models
@@ -83,7 +102,8 @@ env_update_model = api.model('EnvUpdate', {
 service_operation_model = api.model('ServiceOperation', {
     'folder_name': fields.String(required=True, description='Name of the folder containing the project'),
     'operation': fields.String(required=True, description='Operation to perform',
-                               enum=['stop', 'restart', 'start', 'update'])
+                               enum=['stop', 'restart', 'start', 'update']),
+    'force': fields.Boolean(description='Rebuild on update even when nothing changed', default=False)
 })
 
 service_restart_model = api.model('ServiceRestart', {
@@ -100,6 +120,13 @@ url_test_model = api.model('UrlTest', {
     'use_vpn': fields.Boolean(description='Use VPN for the request', default=True)
 })
 
+prune_model = api.model('DockerPrune', {
+    'dry_run': fields.Boolean(description='Only report what would be removed', default=True),
+    'keep_versions': fields.Integer(description='Image versions to always keep per repository', default=3),
+    'max_age_days': fields.Float(description='Only remove unused images and build cache older than this', default=14),
+    'build_cache': fields.Boolean(description='Also prune the build cache', default=True)
+})
+
 vpn_control_model = api.model('VpnControl', {
     'action': fields.String(required=True, description='Action to perform on VPN container',
                             enum=['start', 'stop', 'restart', 'switch']),
@@ -107,15 +134,47 @@ vpn_control_model = api.model('VpnControl', {
 })
 
 
-def get_size(size_in_bytes):
-    # Convert size from bytes to a human-readable format
-    size_units = ['B', 'KB', 'MB', 'GB', 'TB']
-    index = 0
-    size = size_in_bytes
-    while size > 1024 and index < len(size_units) - 1:
-        size /= 1024
-        index += 1
-    return f"{size:.2f} {size_units[index]}"
+def timed_marshal_with(model, **kwargs):
+    """Same as ns.marshal_with, but records the handler and the marshalling as separate timing spans."""
+    def decorator(func):
+        @functools.wraps(func)
+        def handler(*args, **kw):
+            with timing.span('handler'):
+                return func(*args, **kw)
+
+        marshalled = ns.marshal_with(model, **kwargs)(handler)
+
+        @functools.wraps(marshalled)
+        def wrapper(*args, **kw):
+            with timing.span('marshal'):
+                return marshalled(*args, **kw)
+
+        return wrapper
+
+    return decorator
+
+
+def collected(name, phase):
+    """
+    Latest values of one of the embedded collectors.
+
+    Served from the scheduler's store while it runs, timed as the `collectors` phase (the collection itself is
+    reported per collector by /monitor/debug/timings). Otherwise (e.g. the app is imported by a WSGI server that
+    does not run __main__) the collector is run on demand, timed as `phase`.
+    """
+    if app_collectors.is_running():
+        with timing.span('collectors'):
+            result = app_collectors.store.snapshot().get(name)
+        if result is None:
+            return None
+        if result['values'] is None and result['error']:
+            raise RuntimeError(result['error'])
+        return result['values']
+    collector = next((c for c in app_collectors.collectors if c.name == name), None)
+    if collector is None:
+        return None
+    with timing.span(phase):
+        return collector.collect()
 
 
 def get_system_info():
@@ -123,48 +182,46 @@ def get_system_info():
         uptime_days, uptime_hours, uptime_minutes = calculate_uptime(system_start_time)
         system_up_time = f"{uptime_days}D {uptime_hours}H {uptime_minutes}M"
 
-        status = parse_status_file("/home/redbull/reports/system_network_usage.json")
-
-        drive_labels = {
-            '/host_fs': 'OS Partition',
-            '/host_fs/home': 'Home Partition',
-            '/host_fs/mnt/newdrive': 'New Drive'
-        }
+        with timing.span('file'):
+            status = parse_status_file("/home/redbull/reports/system_network_usage.json")
 
         if 'No file' not in status:
+            results = status.get('collectors', {})
+
+            def values(name):
+                return (results.get(name) or {}).get('values') or {}
+
+            network, system = values('network'), values('system')
+            uploaded = network.get('instance_total_upload', 0)
+            downloaded = network.get('instance_total_download', 0)
+            # On EC2 the monthly total comes from CloudWatch, elsewhere it is what this boot transferred
+            total = values('aws_bandwidth').get('total_bandwidth', uploaded + downloaded)
             result = {
                 "isMainServer": system_type == 'Main Server',
                 "isRunning": True,
                 "items": [
                     {"label": "Uptime", "number": system_up_time},
-                    {"label": "Upload", "number": status.get('current_upload_speed', '0 B/s')},
-                    {"label": "Download", "number": status.get('current_download_speed', '0 B/s')},
-                    {"label": "Downloaded", "number": status.get('instance_total_download', '0 KB')},
-                    {"label": "Uploaded", "number": status.get('instance_total_upload', '0 KB')},
-                    {"label": "Total", "number": status.get('monthly_total_bandwidth_used', '0 GB')}
+                    {"label": "Upload", "number": f"{convert_size(network.get('upload_bytes_per_second', 0))}/s"},
+                    {"label": "Download",
+                     "number": f"{convert_size(network.get('download_bytes_per_second', 0))}/s"},
+                    {"label": "Downloaded", "number": convert_size(downloaded)},
+                    {"label": "Uploaded", "number": convert_size(uploaded)},
+                    {"label": "Total", "number": convert_size(total)}
                 ],
                 "usage": [
-                    {"label": "CPU Usage", "number": status.get('cpu_percent', 0.0)},
-                    {"label": "Memory Usage", "number": status.get('memory_percent', 0.0)}
+                    {"label": "CPU Usage", "number": system.get('cpu_percent', 0.0)},
+                    {"label": "Memory Usage", "number": system.get('memory_percent', 0.0)}
                 ],
             }
 
-            disk_usage = []
-            seen = set()
-            relevant_mount_points = ['/host_fs', '/host_fs/home', '/host_fs/mnt/newdrive']
-
-            for part in psutil.disk_partitions():
-                if part.mountpoint in relevant_mount_points and part.mountpoint not in seen:
-                    seen.add(part.mountpoint)
-                    usage = psutil.disk_usage(part.mountpoint)
-                    label = drive_labels.get(part.mountpoint, 'Partition')
-                    disk_usage.append({
-                        "label": label,
-                        "size": get_size(usage.total),
-                        "used": get_size(usage.used),
-                        "available": get_size(usage.free),
-                        "percent": usage.percent
-                    })
+            disk = collected('disk', 'psutil') or {}
+            disk_usage = [{
+                "label": partition['label'],
+                "size": convert_size(partition['total']),
+                "used": convert_size(partition['used']),
+                "available": convert_size(partition['free']),
+                "percent": partition['percent']
+            } for partition in disk.get('partitions', [])]
             if disk_usage:
                 result["disk_usage"] = disk_usage
             return result
@@ -178,33 +235,13 @@ def get_system_info():
 
 def get_docker_stats():
     try:
-        containers = client.containers.list()
-        stats = []
-        for container in containers:
-            container_stats = container.stats(stream=False)
-            cpu_stats = container_stats['cpu_stats']
-            precpu_stats = container_stats['precpu_stats']
-            cpu_usage = cpu_stats['cpu_usage']
-            percpu_usage = cpu_usage.get('percpu_usage', [cpu_usage['total_usage']])
-
-            if 'system_cpu_usage' in cpu_stats and 'system_cpu_usage' in precpu_stats:
-                cpu_delta = cpu_usage['total_usage'] - precpu_stats['cpu_usage']['total_usage']
-                system_cpu_delta = cpu_stats['system_cpu_usage'] - precpu_stats['system_cpu_usage']
-                number_cpus = len(percpu_usage)
-                cpu_percent = (cpu_delta / system_cpu_delta) * number_cpus * 100.0 if system_cpu_delta > 0 else 0.0
-            else:
-                cpu_percent = 0.0
-
-            memory_stats = container_stats['memory_stats']
-            memory_usage = (memory_stats['usage'] / memory_stats['limit']) * 100.0 if memory_stats['limit'] > 0 else 0.0
-
-            stats.append({
-                'container_name': container.name,
-                'cpu_usage': f"{cpu_percent:.2f}%",
-                'memory_usage': f"{memory_usage:.2f}%"
-            })
-        return stats
-    except docker.errors.DockerException as e:
+        docker_stats = collected('docker', 'docker') or {}
+        return [{
+            'container_name': container['name'],
+            'cpu_usage': f"{container['cpu_percent']:.2f}%",
+            'memory_usage': f"{container['memory_percent']:.2f}%"
+        } for container in docker_stats.get('containers', [])]
+    except (docker_client.DockerUnavailable, docker_client.DockerException, RuntimeError) as e:
         return {'message': 'Docker error: ' + str(e)}, 500
     except Exception as e:
         return {'message': 'An error occurred: ' + str(e)}, 500
@@ -213,7 +250,7 @@ def get_docker_stats():
 @ns.route('/system')
 class SystemInfo(Resource):
     @ns.doc('get_system_info', description="Retrieve system information including CPU, memory, and disk usage.")
-    @ns.marshal_with(system_model)
+    @timed_marshal_with(system_model)
     def get(self):
         """
         Get the current system statistics.
@@ -226,7 +263,7 @@ class SystemInfo(Resource):
 @ns.route('/docker')
 class DockerInfo(Resource):
     @ns.doc('get_docker_info', description="Retrieve Docker container stats including CPU and memory usage.")
-    @ns.marshal_with(docker_model, as_list=True)
+    @timed_marshal_with(docker_model, as_list=True)
     def get(self):
         """
         Get the current Docker container statistics.
@@ -236,6 +273,106 @@ class DockerInfo(Resource):
         return get_docker_stats()
 
 
+@ns.route('/docker/events')
+class DockerEvents(Resource):
+    @ns.doc('docker_events', params={'since': 'Only return events after this unix timestamp'})
+    def get(self):
+        """
+        Get the recent container events.
+
+        Events come from a bounded in-memory log fed by the Docker events stream, which also keeps the
+        container inventory used by the other endpoints up to date.
+        """
+        try:
+            since = float(request.args.get('since', 0))
+        except ValueError:
+            return {'message': 'since must be a unix timestamp'}, 400
+        return jsonify({'events': inventory.events_since(since), 'inventory': inventory.status()})
+
+
+@ns.route('/docker/disk')
+class DockerDisk(Resource):
+    @ns.doc('docker_disk', description="Disk usage of Docker images, volumes and build cache.")
+    def get(self):
+        """
+        Get the Docker disk usage per image, volume and build cache entry, with the reclaimable space.
+
+        The numbers come from a cached `docker system df` refreshed in the background every few minutes, this
+        endpoint never waits for the daemon. It returns 202 until the first refresh finished.
+        """
+        result = docker_disk.disk_usage.get()
+        return result, 200 if result['usage'] is not None else 202
+
+
+@ns.route('/docker/disk/prune')
+class DockerPrune(Resource):
+    @ns.doc('docker_prune_jobs', description="List the recent prune jobs with their reports.")
+    def get(self):
+        return jsonify(docker_disk.prune_jobs.list())
+
+    @ns.doc('docker_prune', description="Start a background prune job, a dry run by default.")
+    @ns.expect(prune_model)
+    def post(self):
+        """
+        Prune old images and build cache according to the retention policy.
+
+        Per repository the newest `keep_versions` images are kept, older unused ones are removed once older than
+        `max_age_days`, untagged ones as well (counted as versions of their compose service when they have its
+        labels). Volumes are never removed. The job runs in the background, poll `/monitor/docker/disk/prune/<job_id>`
+        for its report.
+        """
+        body = request.json or {}
+        try:
+            job = docker_disk.prune_jobs.start(
+                dry_run=bool(body.get('dry_run', True)),
+                keep_versions=int(body.get('keep_versions', docker_disk.keep_versions_default)),
+                max_age_days=float(body.get('max_age_days', docker_disk.max_age_days_default)),
+                build_cache=bool(body.get('build_cache', True)))
+        except (TypeError, ValueError):
+            return {'message': 'keep_versions and max_age_days must be numbers'}, 400
+        if job is None:
+            return {'message': 'A prune job is already running'}, 409
+        return job, 202
+
+
+@ns.route('/docker/disk/prune/<job_id>')
+class DockerPruneJob(Resource):
+    @ns.doc('docker_prune_job', description="Get the status and report of a prune job.")
+    def get(self, job_id):
+        job = docker_disk.prune_jobs.get(job_id)
+        if job is None:
+            return {'message': f'Prune job {job_id} not found'}, 404
+        return job
+
+
+@ns.route('/processes')
+class ProcessTable(Resource):
+    @ns.doc('get_processes', params={'sort': f"One of {', '.join(SORT_KEYS)} (default cpu)",
+                                     'limit': 'Number of processes to return (default 20)'})
+    def get(self):
+        """
+        Get the top processes of the host, inside or outside containers.
+
+        CPU usage is measured between two sampling passes, so the first call after startup reports 0% for every
+        process. Passes are reused for a second, so polling this endpoint does not multiply the sampling cost.
+        """
+        sort = request.args.get('sort', 'cpu')
+        if sort not in SORT_KEYS:
+            return {'message': f"sort must be one of {', '.join(SORT_KEYS)}"}, 400
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 500)
+        except ValueError:
+            return {'message': 'limit must be a number'}, 400
+
+        with timing.span('psutil'):
+            processes = process_sampler.top(sort, limit)
+        # Only name the containers when the inventory is loaded, never block this endpoint on Docker
+        names = {container.id: container.name for container in inventory.all()} if inventory.synced else {}
+        for process in processes:
+            process['container'] = names.get(process['container_id'])
+        return jsonify({'processes': processes, 'sample_seconds': round(process_sampler.last_duration, 4)})
+
+
 @ns.route('/restart')
 class RestartService(Resource):
     @ns.doc('restart_service', description="Restart the server, database, or Redis service.")
@@ -254,17 +391,15 @@ class RestartService(Resource):
         try:
             if service == 'server':
                 subprocess.run(['reboot'])
-            elif service == 'db':
-                client.containers.get('mariadb').restart()
-            elif service == 'redis':
-                client.containers.get('redis').restart()
             else:
-                if client.containers.get(service):
-                    client.containers.get(service).restart()
-                else:
-                    return {'message': f'{service} is not a valid container name to restart'}, 400
+                container_name = service_containers.get(service, service)
+                with timing.span('docker'):
+                    container = inventory.get(container_name)
+                    if container is None:
+                        return {'message': f'{service} is not a valid container name to restart'}, 400
+                    container.restart()
             return jsonify({'status': 'success'})
-        except docker.errors.DockerException as e:
+        except (docker_client.DockerUnavailable, docker_client.DockerException) as e:
             return {'message': 'Docker error: ' + str(e)}, 500
         except Exception as e:
             return {'message': 'An error occurred: ' + str(e)}, 500
@@ -288,17 +423,15 @@ class StopService(Resource):
         try:
             if service == 'server':
                 subprocess.run(['shutdown', '-h', 'now'])
-            elif service == 'db':
-                client.containers.get('mariadb').stop()
-            elif service == 'redis':
-                client.containers.get('redis').stop()
             else:
-                if client.containers.get(service):
-                    client.containers.get(service).stop()
-                else:
-                    return {'message': f'{service} is not a valid container name to stop'}, 400
+                container_name = service_containers.get(service, service)
+                with timing.span('docker'):
+                    container = inventory.get(container_name)
+                    if container is None:
+                        return {'message': f'{service} is not a valid container name to stop'}, 400
+                    container.stop()
             return jsonify({'status': 'success'})
-        except docker.errors.DockerException as e:
+        except (docker_client.DockerUnavailable, docker_client.DockerException) as e:
             return {'message': 'Docker error: ' + str(e)}, 500
         except Exception as e:
             return {'message': 'An error occurred: ' + str(e)}, 500
@@ -307,7 +440,7 @@ class StopService(Resource):
 @ns.route('/env')
 class ManageEnv(Resource):
     @ns.doc('get_env', description="Retrieve the contents of the environment variables file.")
-    @ns.marshal_with(env_model)
+    @timed_marshal_with(env_model)
     def get(self):
         """
         Get the current environment variables.
@@ -327,35 +460,64 @@ class ManageEnv(Resource):
         """
         Update the environment variables.
 
-        This endpoint allows updating the environment variables in the `.env` file. If relevant database credentials are updated, the changes will be applied to the database as well.
+        This endpoint allows updating the environment variables in the `.env` file. The file is replaced atomically and
+        only the variables whose value changed are acted upon: database credentials are applied to the running MariaDB,
+        and only the containers created with an old value of a changed variable are recreated.
         """
-        new_env = request.json
+        updates = {key: value for key, value in request.json.items() if key in env_update_model.keys() and value}
         env_file = f'{home}/secrets/.env'
 
-        # Load existing environment variables
-        existing_env = {}
-        if os.path.exists(env_file):
-            with open(env_file, 'r') as file:
-                for line in file:
-                    if '=' in line:
-                        key, value = line.strip().split('=', 1)
-                        existing_env[key] = value
-
-        # Update only the provided environment variables
-        for key, value in new_env.items():
-            if key in env_update_model.keys() and value:
-                existing_env[key] = value
+        actions = []
+        db_keys = set()
+        applied = {}
 
-        # Write updated environment variables back to the .env file
-        with open(env_file, 'w') as file:
-            for key, value in existing_env.items():
-                file.write(f'{key}={value}\n')
+        def apply_to_database(old_env, new_env, changed):
+            # Database credentials are applied live, MariaDB only reads them when it initializes its data directory.
+            # This runs before the .env is replaced, with the old root password, so a failure leaves both unchanged
+            db_keys.update({'MYSQL_ROOT_PASSWORD', 'MYSQL_DATABASE', 'MYSQL_USER', 'MYSQL_PASSWORD'} & changed)
+            if db_keys:
+                actions.extend(f'mariadb: {action}' for action in db.apply_credentials(old_env, new_env, changed))
+                applied.update(old_env=old_env, new_env=new_env, changed=changed)
 
-        # Apply changes to the database if relevant variables are updated
-        if {'MYSQL_ROOT_PASSWORD', 'MYSQL_DATABASE', 'MYSQL_USER', 'MYSQL_PASSWORD'} & new_env.keys():
-            update_db_credentials(new_env)
+        try:
+            old_env, new_env, changed = update_env(env_file, updates, before_write=apply_to_database)
+        except Exception as e:
+            if not applied:
+                logger.error(f"Unable to apply the database credentials: {e}")
+                return {'message': f'The database could not be updated, .env left unchanged: {e}'}, 500
+            # MariaDB already has the new credentials but the .env still holds the old ones, put the old ones back
+            logger.error(f"Unable to write {env_file} after updating the database: {e}")
+            try:
+                db.apply_credentials(applied['new_env'], applied['old_env'], applied['changed'])
+            except Exception as rollback_error:
+                logger.error(f"Unable to restore the previous database credentials: {rollback_error}")
+                return {'message': f'.env could not be written ({e}) and the database credentials could not be '
+                                   f'restored ({rollback_error}), MariaDB now uses the requested values',
+                        'applied': actions}, 500
+            return {'message': f'.env could not be written, the database credentials were restored: {e}'}, 500
+        if not changed:
+            return jsonify({'status': 'success', 'changed': [], 'actions': []})
+
+        # Only containers holding an old value of a changed variable have to be recreated
+        recreate = []
+        import requests  # Already loaded by docker, only needed to recognize its connection errors
+        try:
+            for container in inventory.using_env(old_env, changed):
+                if container.name == 'mariadb' and changed <= db_keys:
+                    continue
+                service = container.labels.get('com.docker.compose.service', container.name)
+                if recreatable(service):
+                    recreate.append(service)
+                else:
+                    actions.append(f'{service}: recreate manually')
+        except (docker_client.DockerUnavailable, docker_client.DockerException, requests.RequestException) as e:
+            # The .env and the database are already updated, report the containers as unchecked instead of failing
+            actions.append(f'containers not checked: {e}')
+        if recreate:
+            threading.Thread(target=recreate_services, args=(recreate,), daemon=True).start()
+            actions += [f'{service}: recreate' for service in recreate]
 
-        return jsonify({'status': 'success'})
+        return jsonify({'status': 'success', 'changed': sorted(changed), 'actions': actions})
 
 
 @ns.route('/service')
@@ -379,14 +541,29 @@ class ServiceOperation(Resource):
             return {'message': f'Directory {folder_name} does not exist.'}, 400
 
         try:
-            result = subprocess.run([f'{home}/server_setup/manage_service.sh', folder_name, operation], check=True,
-                                    capture_output=True)
+            command = [f'{home}/server_setup/manage_service.sh', folder_name, operation]
+            if request.json.get('force'):
+                command.append('force')
+            result = subprocess.run(command, check=True, capture_output=True)
             output = result.stdout.decode() + result.stderr.decode()
             return jsonify({'status': 'success', 'output': output})
         except subprocess.CalledProcessError as e:
             return {'message': e.stderr.decode()}, 500
 
 
+@ns.route('/projects')
+class Projects(Resource):
+    @ns.doc('get_projects', description="Git status of every project folder under ~/GIT.")
+    def get(self):
+        """
+        Get the branch, HEAD, ahead/behind and dirty status of every managed project.
+
+        Ahead/behind are relative to the last fetch of the upstream branch. Results are cached per repository until
+        one of its refs changes.
+        """
+        return jsonify(projects.list())
+
+
 # VPN Health Check Endpoint
 @ns.route('/vpn/health')
 class VpnHealthCheck(Resource):
@@ -396,12 +573,13 @@ class VpnHealthCheck(Resource):
         Check if the VPN container is running and healthy.
         """
         try:
-            vpn_container = client.containers.get(vpn_container_name)
+            with timing.span('docker'):
+                vpn_container = inventory.get(vpn_container_name)
+            if vpn_container is None:
+                return {'status': 'Container not found', 'running': False}, 404
             health_status = vpn_container.attrs['State']['Health']['Status'] if 'Health' in vpn_container.attrs[
                 'State'] else 'Unknown'
             return jsonify({'status': health_status, 'running': vpn_container.status == 'running'})
-        except docker.errors.NotFound:
-            return jsonify({'status': 'Container not found', 'running': False}), 404
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -418,7 +596,9 @@ class VpnControl(Resource):
         action = request.json.get('action')
         server = request.json.get('server', None)
         try:
-            vpn_container = client.containers.get(vpn_container_name)
+            vpn_container = inventory.get(vpn_container_name)
+            if vpn_container is None:
+                return {'message': 'VPN container not found'}, 404
             if action == 'start':
                 vpn_container.start()
                 return {'message': 'VPN started'}, 200
@@ -439,8 +619,6 @@ class VpnControl(Resource):
                 return {'message': f'VPN switched to server: {server}'}, 200
             else:
                 return {'message': 'Invalid action'}, 400
-        except docker.errors.NotFound:
-            return {'message': 'VPN container not found'}, 404
         except Exception as e:
             return {'message': str(e)}, 500
 
@@ -465,14 +643,17 @@ class VpnTestUrl(Resource):
                           "Chrome/122.0.0.0 Safari/537.36"
         }
 
+        import requests  # Only needed for this rarely used endpoint, keep it out of the startup path
+
         try:
-            if use_vpn:
-                # Make request using the VPN proxy
-                proxies = {'http': 'http://gluetun:8888', 'https': 'http://gluetun:8888'}
-                response = requests.get(url, headers=common_headers, proxies=proxies)
-            else:
-                # Make request without VPN
-                response = requests.get(url, headers=common_headers)
+            with timing.span('upstream'):
+                if use_vpn:
+                    # Make request using the VPN proxy
+                    proxies = {'http': 'http://gluetun:8888', 'https': 'http://gluetun:8888'}
+                    response = requests.get(url, headers=common_headers, proxies=proxies)
+                else:
+                    # Make request without VPN
+                    response = requests.get(url, headers=common_headers)
             # Get content type from the response
             content_type = response.headers.get('Content-Type', '').lower()
 
@@ -493,191 +674,229 @@ class VpnTestUrl(Resource):
 
 @ns.route('/health')
 class HealthCheck(Resource):
-    @ns.doc('healthcheck')
+    @ns.doc('healthcheck', description="Liveness check, answers as soon as the API process is up.")
     def get(self):
         return jsonify({'status': 'healthy'})
 
 
-def update_db_credentials(new_env):
-    mariadb_container = client.containers.get('mariadb')
-    mariadb_container.exec_run(
-        f"mysql -u root -p {new_env['MYSQL_ROOT_PASSWORD']} -e \"ALTER USER '{new_env['MYSQL_USER']}'@'%' IDENTIFIED BY '{new_env['MYSQL_PASSWORD']}';\""
-    )
-    mariadb_container.restart()
-
-
-# # Store active streams (stream_id -> stream details)
-# active_streams = {}
-#
-#
-# class StreamBuffer:
-#     def __init__(self):
-#         self.buffer = deque()
-#         self.lock = threading.Lock()
-#
-#     def append(self, data):
-#         with self.lock:
-#             self.buffer.append(data)
-#
-#     def get_chunk(self):
-#         with self.lock:
-#             if self.buffer:
-#                 return self.buffer.popleft()
-#             return None
-#
-#
-# def start_ffmpeg(stream_id, stream_url):
-#     """Starts an FFmpeg process for a given stream_id and URL with error handling."""
-#     ffmpeg_command = [
-#         'ffmpeg', '-re', '-i', stream_url,
-#         '-c:v', 'copy', '-c:a', 'aac',  # Use AAC for audio
-#         '-b:a', '128k',  # Set audio bitrate
-#         '-f', 'mpegts',
-#         '-fflags', 'nobuffer',
-#         '-flush_packets', '1',
-#         'pipe:1'
-#     ]
-#
-#     process = subprocess.Popen(
-#         ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=10 ** 6
-#     )
-#
-#     # Initialize stream buffer
-#     active_streams[stream_id] = {
-#         'process': process,
-#         'clients': defaultdict(lambda: {'buffer': StreamBuffer(), 'active': True}),
-#         'stop': False,
-#         'last_chunk_time': time.time()  # Track when the last chunk was received
-#     }
-#
-#     def monitor_process():
-#         """Monitor FFmpeg process and restart if it crashes or exits."""
-#         while stream_id in active_streams and not active_streams[stream_id]['stop']:
-#             try:
-#                 stderr_output = active_streams[stream_id]['process'].stderr.readline()
-#                 if stderr_output:
-#                     logger.error(f"FFmpeg error in stream {stream_id}: {stderr_output.decode()}")
-#                     if "Error" in stderr_output.decode():
-#                         logger.info(f"Restarting FFmpeg for stream {stream_id} due to an error.")
-#                         cleanup_stream(stream_id)
-#                         start_ffmpeg(stream_id, active_streams[stream_id]['url'])
-#                         return
-#             except KeyError:
-#                 logger.info(f"Stream {stream_id} has already been stopped and removed.")
-#                 break
-#         logger.info(f"Exiting monitor process for stream {stream_id}.")
-#
-#     def read_stream():
-#         """Read the FFmpeg process output and distribute to clients."""
-#         try:
-#             while not active_streams[stream_id]['stop']:
-#                 chunk = process.stdout.read(4096)
-#                 if not chunk:
-#                     logger.info(f"Source stream ended for {stream_id}. Stopping restream.")
-#                     break
-#
-#                 active_streams[stream_id]['last_chunk_time'] = time.time()  # Update the last received chunk time
-#
-#                 # Append chunk to all active clients
-#                 for client_data in list(active_streams[stream_id]['clients'].values()):
-#                     if client_data['active']:
-#                         client_data['buffer'].append(chunk)
-#
-#                 # Timeout detection - Restart the process if no data is received for a while
-#                 if time.time() - active_streams[stream_id]['last_chunk_time'] > 10:
-#                     logger.warning(f"Stream {stream_id} timed out. Restarting.")
-#                     cleanup_stream(stream_id)
-#                     start_ffmpeg(stream_id, stream_url)
-#                     return
-#         except Exception as e:
-#             logger.error(f"Error while reading stream {stream_id}: {e}")
-#         finally:
-#             cleanup_stream(stream_id)
-#
-#     threading.Thread(target=read_stream, daemon=True).start()
-#     threading.Thread(target=monitor_process, daemon=True).start()
-#     return process
-#
-#
-# def cleanup_stream(stream_id):
-#     """Ensures proper cleanup of FFmpeg process and resources."""
-#     try:
-#         if stream_id in active_streams:
-#             logger.info(f"Cleaning up stream {stream_id}")
-#             active_streams[stream_id]['stop'] = True  # Signal all threads to stop
-#
-#             process = active_streams[stream_id]['process']
-#             process.kill()  # Ensure the FFmpeg process is stopped
-#
-#             # Allow threads to exit before deleting the stream entry
-#             time.sleep(1)
-#
-#             # Ensure the stream is removed after threads have safely exited
-#             del active_streams[stream_id]
-#             logger.info(f"Stream {stream_id} fully terminated.")
-#     except Exception as e:
-#         logger.error(f"Stream was already deleted.. {stream_id}: {e}")
-#
-#
-# @ns.route('/restream/<stream_id>/<username>')
-# class Restream(Resource):
-#     @ns.doc('restream')
-#     def get(self, stream_id, username):
-#         logger.info(f"Stream starting for: {stream_id}, User: {username}")
-#
-#         # Get stream URL (fallback to default test stream)
-#         stream_url = request.args.get('url', "http://test-streams.mux.dev/x36xhzz/x36xhzz.m3u8")
-#         if not stream_url:
-#             return {"error": "stream_url is required"}, 400
-#
-#         # Start FFmpeg if the stream is not already active
-#         if stream_id not in active_streams:
-#             start_ffmpeg(stream_id, stream_url)
-#
-#         # Handle client-specific data
-#         client_data = active_streams[stream_id]['clients'][username]
-#
-#         # Mark the client as active
-#         client_data['active'] = True
-#
-#         # Clear buffer and reset on reconnect to prevent old chunks from being sent
-#         if 'buffer' in client_data:
-#             logger.info(f"Clearing buffer for user {username} on reconnect")
-#             client_data['buffer'] = StreamBuffer()
-#         else:
-#             client_data['buffer'] = StreamBuffer()
-#
-#         process = active_streams[stream_id]['process']
-#
-#         def generate():
-#             while True:
-#                 chunk = client_data['buffer'].get_chunk()
-#                 if chunk:
-#                     yield chunk
-#                 else:
-#                     time.sleep(0.1)
-#
-#         # Response with generated stream data
-#         response = Response(generate(), content_type='video/mp2t')
-#
-#         @response.call_on_close
-#         def on_close():
-#             # Handle client disconnection
-#             client_data['active'] = False
-#             logger.info(f"Client {username} disconnected from stream {stream_id}")
-#
-#             # Fully clean up client if no more clients are active
-#             if all(not c['active'] for c in active_streams[stream_id]['clients'].values()):
-#                 logger.info(f"No more clients active. Stopping stream {stream_id}")
-#                 cleanup_stream(stream_id)
-#             else:
-#                 # Additional safeguard to remove client-specific data
-#                 if username in active_streams[stream_id]['clients']:
-#                     logger.info(f"Cleaning up user {username} data for stream {stream_id}")
-#                     del active_streams[stream_id]['clients'][username]
-#
-#         return response
+@ns.route('/ready')
+class ReadinessCheck(Resource):
+    @ns.doc('readiness', description="Readiness check, 503 until the container inventory is loaded.")
+    def get(self):
+        """
+        Check if the API is ready to serve Docker backed endpoints.
+        """
+        ready = docker_client.is_ready() and inventory.synced
+        body = {'status': 'ready' if ready else 'starting', 'docker': docker_client.status(),
+                'inventory': inventory.status()}
+        return body, 200 if ready else 503
+
+
+@ns.route('/debug/timings')
+class DebugTimings(Resource):
+    @ns.doc('debug_timings', description="Aggregated per endpoint and per phase request timing histograms.")
+    def get(self):
+        """
+        Get the request timing histograms.
+
+        Phases are docker, psutil, file, upstream, collectors, handler and marshal, plus the request total. Append
+        `?reset=1` to clear the histograms after reading them. `collectors` has the duration, time and error of the
+        last run of every embedded collector, the Docker and psutil work behind /docker and /system happens there.
+        Any endpoint can be profiled with `?profile=1` when ENABLE_PROFILING is set, which returns a folded stack
+        dump usable with flamegraph tools.
+        """
+        timings = timing.get_timings()
+        if request.args.get('reset') == '1':
+            timing.reset_timings()
+        return jsonify({'enabled': timing.timing_enabled, 'profiling_enabled': timing.profiling_enabled,
+                        'buckets_ms': [str(bound) for bound in timing.BUCKETS_MS], 'timings': timings,
+                        'collectors': {name: {key: result[key] for key in ('duration', 'timestamp', 'error')}
+                                       for name, result in app_collectors.store.snapshot().items()}})
+
+
+@ns.route('/probes')
+class NetworkProbes(Resource):
+    @ns.doc('network_probes', description="Latency, jitter and packet loss from this node to its probe targets.")
+    def get(self):
+        """
+        Get the link quality measured by network_monitor.py.
+
+        Every target reports its RTT percentiles and jitter in milliseconds and its loss over the probe window.
+        """
+        with timing.span('file'):
+            status = parse_status_file(f"{home}/reports/system_network_usage.json")
+        result = status.get('collectors', {}).get('probe') if isinstance(status, dict) else None
+        if not result or not result['values']:
+            return {'message': 'No probe results available'}, 503
+
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        targets = [{**target, **{key: ms(target[key]) for key in
+                                 ('last_rtt', 'rtt_min', 'rtt_p50', 'rtt_p90', 'rtt_p99', 'rtt_max', 'jitter')}}
+                   for target in result['values']['targets']]
+        return jsonify({'timestamp': result['timestamp'], 'icmp_permitted': result['values']['icmp_permitted'],
+                        'error': result['error'], 'unit': 'ms', 'targets': targets})
+
+
+@ns.route('/archive')
+class MetricsArchive(Resource):
+    @ns.doc('metrics_archive', description="Query the metrics history archived by network_monitor.py.",
+            params={'series': 'Comma separated series names, omit to list them',
+                    'start': 'Start as seconds since the epoch, defaults to 24 hours before end',
+                    'end': 'End as seconds since the epoch, defaults to now',
+                    'resolution': 'raw, 1m, 1h or auto (default, at most ARCHIVE_MAX_POINTS points)'})
+    def get(self):
+        """
+        Get archived metrics over a time range.
+
+        Series are named after their collector, e.g. network.upload_bytes_per_second or probe.redis.rtt_p50. Raw
+        samples return their values, the 1m and 1h rollups avg/min/max per bucket.
+        """
+        directory = f"{home}/reports/archive"
+        series = [name for name in request.args.get('series', '').split(',') if name]
+        if not series:
+            with timing.span('file'):
+                return jsonify({'series': archive.series_names(directory)})
+        try:
+            end = float(request.args.get('end', time.time()))
+            start = float(request.args.get('start', end - 86400))
+        except ValueError:
+            return {'message': 'start and end must be seconds since the epoch'}, 400
+        if start > end:
+            return {'message': 'start must be before end'}, 400
+        try:
+            with timing.span('file'):
+                result = archive.query(directory, series, start, end, request.args.get('resolution', 'auto'))
+        except ValueError as e:
+            return {'message': str(e)}, 400
+        return jsonify(result)
+
+
+@ns.route('/self')
+class SelfMonitoring(Resource):
+    @ns.doc('self_monitoring', description="Resource usage and loop timings of the monitoring processes themselves.")
+    def get(self):
+        """
+        Get the overhead of the monitoring processes.
+
+        Reports CPU time, RSS, threads, open FDs, loop iteration duration, sampler lag and the current budget state
+        of both this API and network_monitor.py, as of their last collector tick, reading them changes nothing.
+        """
+        status = parse_status_file(f"{home}/reports/system_network_usage.json")
+        network_monitor = status.get('monitor') if isinstance(status, dict) else None
+        return jsonify({'app': app_monitor.snapshot(), 'network_monitor': network_monitor})
+
+
+def recreatable(service):
+    """Only the projects under ~/GIT can be recreated with manage_service.sh, and never this API itself."""
+    return 'server_setup' not in service and os.path.isdir(f"{home}/GIT/{service}")
+
+
+def recreate_services(services):
+    """Recreate compose services so they pick up the new env file, one at a time."""
+    for service in services:
+        result = subprocess.run([f'{home}/server_setup/manage_service.sh', service, 'recreate'], capture_output=True)
+        if result.returncode != 0:
+            logger.error(f"Unable to recreate {service}: {result.stderr.decode()}")
+        else:
+            logger.info(f"Recreated {service} after the .env update")
+
+
+@ns.route('/restream/<stream_id>/<username>')
+class Restream(Resource):
+    @ns.doc('restream', params={'url': 'Source stream URL, only used when the stream is not running yet'})
+    def get(self, stream_id, username):
+        """
+        Relay a source stream as MPEG-TS.
+
+        A single ffmpeg process per stream id is shared by all viewers. Viewers that fall too far behind
+        are disconnected, and the ffmpeg process is stopped once nobody watched the stream for a while.
+        """
+        logger.info(f"Stream starting for: {stream_id}, User: {username}")
+
+        # Get stream URL (fallback to default test stream)
+        stream_url = request.args.get('url', "http://test-streams.mux.dev/x36xhzz/x36xhzz.m3u8")
+        if not stream_url:
+            return {"error": "stream_url is required"}, 400
+
+        stream = restreams.get_or_start(stream_id, stream_url)
+        viewer = stream.attach(username)
+        return Response(stream.iter_viewer(viewer), content_type='video/mp2t', direct_passthrough=True)
+
+
+@ns.route('/restream/<stream_id>/hls/<filename>')
+class RestreamHls(Resource):
+    @ns.doc('restream_hls', params={'url': 'Source stream URL, only used when the stream is not running yet'})
+    def get(self, stream_id, filename):
+        """
+        Serve a restream as HLS.
+
+        Requesting `index.m3u8` starts (or keeps alive) an ffmpeg process segmenting the source, the segments
+        it references are served from an LRU segment cache with immutable cache headers and range support,
+        so reconnecting viewers and the reverse proxy get them without touching the source again.
+        """
+        if not hls.is_safe_name(stream_id) or not hls.is_safe_name(filename):
+            return {'message': 'Invalid stream id or file name'}, 400
+
+        if filename == hls.PLAYLIST_NAME:
+            stream_url = request.args.get('url', "http://test-streams.mux.dev/x36xhzz/x36xhzz.m3u8")
+            stream = hls.hls_streams.get_or_start(stream_id, stream_url)
+            if not hls.hls_streams.wait_for_playlist(stream, timeout=hls.segment_seconds * 4):
+                return {'message': f'Stream {stream_id} did not produce a playlist'}, 504
+            with open(stream.playlist_path, 'rb') as file:
+                data = file.read()
+            response = Response(data, mimetype='application/vnd.apple.mpegurl')
+            response.cache_control.no_cache = True
+            response.add_etag()
+        elif filename.endswith('.ts'):
+            stream = hls.hls_streams.get(stream_id)
+            if stream:
+                stream.last_request = time.time()
+            data = hls.hls_streams.cache.get(os.path.join(hls.hls_dir, stream_id, filename))
+            if data is None:
+                return {'message': f'Segment {filename} is not available'}, 404
+            response = Response(data, mimetype='video/mp2t')
+            # Segment names are never reused, so proxies and players can keep them forever
+            response.cache_control.public = True
+            response.cache_control.max_age = 86400
+            response.cache_control.immutable = True
+            response.set_etag(f"{stream_id}-{filename}-{len(data)}")
+        else:
+            return {'message': f'Unknown file {filename}'}, 404
+
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+
+@ns.route('/restream/<stream_id>/hls')
+class RestreamHlsControl(Resource):
+    @ns.doc('restream_hls_stop', description="Stop an HLS restream and delete its cached segments.")
+    def delete(self, stream_id):
+        if not hls.hls_streams.remove(stream_id):
+            return {'message': f'HLS stream {stream_id} is not running'}, 404
+        return {'message': f'HLS stream {stream_id} stopped'}, 200
+
+
+@ns.route('/restream')
+class RestreamList(Resource):
+    @ns.doc('restream_metrics', description="List the active restreams with their relay, client and HLS cache metrics.")
+    def get(self):
+        return jsonify({'relay': restreams.metrics(), 'hls': hls.hls_streams.metrics()})
+
+
+@ns.route('/restream/<stream_id>')
+class RestreamControl(Resource):
+    @ns.doc('restream_stop', description="Stop a restream and disconnect all of its clients.")
+    def delete(self, stream_id):
+        if not restreams.stop(stream_id):
+            return {'message': f'Stream {stream_id} is not running'}, 404
+        return {'message': f'Stream {stream_id} stopped'}, 200
 
 
 if __name__ == '__main__':
+    # Connects to Docker in the background and keeps the container inventory current from its events
+    inventory.start()
+    app_collectors.start()
+    if docker_disk.prune_interval_hours > 0:
+        docker_disk.prune_jobs.schedule(docker_disk.prune_interval_hours)
     app.run(host='0.0.0.0', port=5000)
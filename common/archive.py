@@ -0,0 +1,493 @@
+import logging
+import math
+import mmap
+import operator
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# Seconds per bucket of every resolution, and how many days of each are kept
+RESOLUTIONS = {'raw': None, '1m': 60, '1h': 3600}
+retention_days = {
+    'raw': float(os.getenv('ARCHIVE_RETENTION_RAW_DAYS', '3')),
+    '1m': float(os.getenv('ARCHIVE_RETENTION_1M_DAYS', '30')),
+    '1h': float(os.getenv('ARCHIVE_RETENTION_1H_DAYS', '730')),
+}
+# Rows buffered in memory before a block is appended, a crash loses at most one block per resolution
+# (the buffers are written on a normal stop)
+block_rows = {
+    'raw': int(os.getenv('ARCHIVE_RAW_BLOCK_ROWS', '150')),
+    '1m': int(os.getenv('ARCHIVE_1M_BLOCK_ROWS', '60')),
+    '1h': int(os.getenv('ARCHIVE_1H_BLOCK_ROWS', '6')),
+}
+# The API reads the files from another process, so a buffer is also written once its oldest row is this old
+flush_seconds = float(os.getenv('ARCHIVE_FLUSH_SECONDS', '60'))
+# Rollup rows are therefore mostly written one or two per block, each repeating the column directory. After this
+# many blocks, and once the day is over, a rollup file is rewritten into blocks of `compact_rows`
+compact_after = int(os.getenv('ARCHIVE_COMPACT_AFTER_BLOCKS', '60'))
+compact_rows = {'1m': 360, '1h': 24}
+# `resolution=auto` picks the finest resolution returning at most this many points
+max_points = int(os.getenv('ARCHIVE_MAX_POINTS', '2000'))
+
+MAGIC = b'MBK1'
+# magic, length of the rest of the block, rows, first and last timestamp (ms), columns
+BLOCK_HEADER = struct.Struct('<4sIIqqH')
+# name length, offset of the column data from the start of the data section, compressed length
+COLUMN_ENTRY = struct.Struct('<HII')
+
+_little_endian = sys.byteorder == 'little'
+
+
+def _shuffle(data, width=8):
+    """Group the n-th byte of every value together, the slowly changing high bytes then compress to almost nothing."""
+    return b''.join(data[i::width] for i in range(width))
+
+
+def _unshuffle(data, width=8):
+    out = bytearray(len(data))
+    plane = len(data) // width
+    for i in range(width):
+        out[i::width] = data[i * plane:(i + 1) * plane]
+    return bytes(out)
+
+
+def _to_bytes(values):
+    if not _little_endian:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if not _little_endian:
+        values.byteswap()
+    return values
+
+
+def encode_timestamps(timestamps):
+    """Millisecond timestamps as delta-of-deltas, a steady sampling interval encodes as zeros."""
+    deltas = [b - a for a, b in zip([0] + timestamps, timestamps)]
+    second = array('q', (b - a for a, b in zip([0] + deltas, deltas)))
+    return zlib.compress(_shuffle(_to_bytes(second)))
+
+
+def decode_timestamps(data):
+    second = _from_bytes('q', _unshuffle(zlib.decompress(data)))
+    return list(accumulate(accumulate(second)))
+
+
+def encode_values(values):
+    """Floats XORed with their predecessor as in Gorilla, byte shuffled and deflated instead of bit packed."""
+    bits = array('Q')
+    bits.frombytes(array('d', values).tobytes())  # The IEEE 754 bit patterns
+    xored = array('Q', (b ^ a for a, b in zip([0] + bits.tolist(), bits)))
+    return zlib.compress(_shuffle(_to_bytes(xored)))
+
+
+def decode_values(data):
+    bits = array('Q', accumulate(_from_bytes('Q', _unshuffle(zlib.decompress(data))), operator.xor))
+    values = array('d')
+    values.frombytes(bits.tobytes())
+    return values
+
+
+def encode_block(rows):
+    """
+    Encode buffered rows as one columnar block.
+
+    Args:
+        rows (list): (timestamp in seconds, {series: value}) tuples, missing values become NaN.
+
+    Returns:
+        bytes: The block, header and column directory first so a reader can skip it or pick single columns.
+    """
+    names = sorted({name for _, values in rows for name in values})
+    timestamps = [int(round(timestamp * 1000)) for timestamp, _ in rows]
+    columns = [('', encode_timestamps(timestamps))]
+    columns += [(name, encode_values([values.get(name, math.nan) for _, values in rows])) for name in names]
+
+    directory, offset = [], 0
+    for name, data in columns:
+        encoded_name = name.encode()
+        directory.append(COLUMN_ENTRY.pack(len(encoded_name), offset, len(data)) + encoded_name)
+        offset += len(data)
+    body = b''.join(directory) + b''.join(data for _, data in columns)
+    header = BLOCK_HEADER.pack(MAGIC, len(body), len(rows), timestamps[0], timestamps[-1], len(columns))
+    return header + body
+
+
+def read_blocks(buffer, start_ms, end_ms):
+    """
+    Yield the blocks of a file overlapping [start_ms, end_ms] as (rows, {name: column bytes}).
+
+    Blocks outside the range are skipped by their header, a block cut short by a crash ends the file.
+    """
+    position, size = 0, len(buffer)
+    while position + BLOCK_HEADER.size <= size:
+        magic, length, rows, first, last, column_count = BLOCK_HEADER.unpack_from(buffer, position)
+        body = position + BLOCK_HEADER.size
+        if magic != MAGIC or body + length > size:
+            break
+        position = body + length
+        if last < start_ms or first > end_ms:
+            continue
+        entries, cursor = [], body
+        for _ in range(column_count):
+            name_length, offset, data_length = COLUMN_ENTRY.unpack_from(buffer, cursor)
+            cursor += COLUMN_ENTRY.size
+            entries.append((bytes(buffer[cursor:cursor + name_length]).decode(), offset, data_length))
+            cursor += name_length
+        yield rows, {name: (cursor + offset, data_length) for name, offset, data_length in entries}
+
+
+def read_rows(buffer):
+    """Decode every row of a file, as (timestamp in seconds, {series: value}) tuples without the NaN values."""
+    rows = []
+    for _, columns in read_blocks(buffer, -2 ** 62, 2 ** 62):
+        offset, length = columns['']
+        timestamps = decode_timestamps(buffer[offset:offset + length])
+        decoded = {name: decode_values(buffer[offset:offset + length])
+                   for name, (offset, length) in columns.items() if name}
+        for i, timestamp in enumerate(timestamps):
+            rows.append((timestamp / 1000, {name: values[i] for name, values in decoded.items()
+                                            if values[i] == values[i]}))
+    return rows
+
+
+def needs_compaction(buffer, rows_per_block):
+    blocks = rows = 0
+    for block_rows_count, _ in read_blocks(buffer, -2 ** 62, 2 ** 62):
+        blocks += 1
+        rows += block_rows_count
+    return blocks > math.ceil(rows / rows_per_block)
+
+
+def compact(path, rows_per_block):
+    """Rewrite a file into blocks of `rows_per_block` rows, readers still mapping the old file keep reading it."""
+    buffer = _mapped(path)
+    if buffer is None:
+        return
+    with buffer:
+        rows = read_rows(buffer)
+    if not rows:
+        return
+    data = b''.join(encode_block(rows[i:i + rows_per_block]) for i in range(0, len(rows), rows_per_block))
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+def flatten(results):
+    """
+    Numeric values of collector results keyed `collector.key`, list items keyed `collector.<item name>.key`.
+
+    Args:
+        results (dict): Collector name -> values, as returned by the collectors.
+    """
+    flat = {}
+    for collector, values in results.items():
+        for key, value in (values or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                flat[f'{collector}.{key}'] = float(value)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict) and 'name' in item:
+                        for item_key, item_value in item.items():
+                            if isinstance(item_value, (int, float)) and not isinstance(item_value, bool):
+                                flat[f"{collector}.{item['name']}.{item_key}"] = float(item_value)
+    return flat
+
+
+def _day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def file_path(directory, resolution, day):
+    return os.path.join(directory, f'{resolution}-{day}.mbk')
+
+
+class Rollup:
+    """Min, max and average of every series over fixed buckets."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.bucket = None
+        self.stats = {}  # series -> [count, sum, min, max]
+
+    def add(self, timestamp, values):
+        """Add a sample, returns the row of the previous bucket once the sample falls in a new one."""
+        bucket = timestamp - timestamp % self.seconds
+        row = None
+        if self.bucket is not None and bucket != self.bucket:
+            row = self.flush()
+        self.bucket = bucket
+        for name, value in values.items():
+            if math.isnan(value):
+                continue
+            stats = self.stats.get(name)
+            if stats is None:
+                self.stats[name] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = min(stats[2], value)
+                stats[3] = max(stats[3], value)
+        return row
+
+    def flush(self):
+        if self.bucket is None or not self.stats:
+            return None
+        values = {}
+        for name, (count, total, minimum, maximum) in self.stats.items():
+            values[f'{name}:avg'] = total / count
+            values[f'{name}:min'] = minimum
+            values[f'{name}:max'] = maximum
+            values[f'{name}:count'] = count
+        row, self.stats = (self.bucket, values), {}
+        return row
+
+
+class ArchiveWriter:
+    """
+    Appends samples to per day files of columnar blocks, one set of files per resolution, and drops
+    files past their retention.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.buffers = {resolution: [] for resolution in RESOLUTIONS}
+        self.buffered_at = {}  # resolution -> sample time at which the oldest buffered row was added
+        self.small_blocks = {}  # path -> blocks appended since the file was last compacted
+        self.rollups = {resolution: Rollup(seconds) for resolution, seconds in RESOLUTIONS.items() if seconds}
+        self.pruned_day = None
+
+    def _flush(self, resolution):
+        rows = self.buffers[resolution]
+        if not rows:
+            return
+        self.buffers[resolution] = []
+        self.buffered_at.pop(resolution, None)
+        path = file_path(self.directory, resolution, _day(rows[0][0]))
+        block = encode_block(rows)
+        # A single append, readers never see a partial block except after a crash, which they skip
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, block)
+        finally:
+            os.close(fd)
+        if resolution in compact_rows:
+            self.small_blocks[path] = self.small_blocks.get(path, 0) + 1
+            if self.small_blocks[path] >= compact_after:
+                self._compact(path, resolution)
+
+    def _compact(self, path, resolution):
+        self.small_blocks.pop(path, None)
+        try:
+            compact(path, compact_rows[resolution])
+        except OSError as e:
+            logger.error(f"Unable to compact {path}: {e}")
+
+    def _add_row(self, resolution, row, now):
+        rows = self.buffers[resolution]
+        # Blocks never span two days, every file holds exactly its own day
+        if rows and _day(rows[0][0]) != _day(row[0]):
+            self._flush(resolution)
+            if resolution in compact_rows:
+                self._compact(file_path(self.directory, resolution, _day(rows[0][0])), resolution)
+        self.buffers[resolution].append(row)
+        self.buffered_at.setdefault(resolution, now)
+        if len(self.buffers[resolution]) >= block_rows[resolution]:
+            self._flush(resolution)
+
+    def append(self, timestamp, values):
+        """
+        Archive one sample.
+
+        Args:
+            timestamp (float): Seconds since the epoch.
+            values (dict): Series name -> number, NaN for a missing value.
+        """
+        if not values:
+            return
+        self._add_row('raw', (timestamp, values), timestamp)
+        for resolution, rollup in self.rollups.items():
+            row = rollup.add(timestamp, values)
+            if row:
+                self._add_row(resolution, row, timestamp)
+        for resolution, buffered_at in list(self.buffered_at.items()):
+            if timestamp - buffered_at >= flush_seconds:
+                self._flush(resolution)
+        day = _day(timestamp)
+        if day != self.pruned_day:
+            self.pruned_day = day
+            self.prune(timestamp)
+
+    def prune(self, now=None):
+        """
+        Delete the files of the days past the retention of their resolution, and compact the rollup files of
+        the previous days left fragmented by a restart.
+        """
+        now = now or time.time()
+        today = _day(now)
+        for name in os.listdir(self.directory):
+            resolution, _, rest = name.partition('-')
+            if resolution not in retention_days or not name.endswith('.mbk'):
+                continue
+            try:
+                day = datetime.strptime(rest[:-len('.mbk')], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+            if (now - (day + timedelta(days=1)).timestamp()) / 86400 > retention_days[resolution]:
+                os.remove(os.path.join(self.directory, name))
+                logger.info(f"Removed archive file {name}, past the {retention_days[resolution]} day retention")
+            elif resolution in compact_rows and rest[:-len('.mbk')] != today:
+                path = os.path.join(self.directory, name)
+                buffer = _mapped(path)
+                if buffer is not None:
+                    with buffer:
+                        fragmented = needs_compaction(buffer, compact_rows[resolution])
+                    if fragmented:
+                        self._compact(path, resolution)
+
+    def close(self):
+        """
+        Write the partial rollup buckets and every buffered row.
+
+        After a restart the current buckets are written a second time with the rest of their samples, `query`
+        merges rows sharing a bucket.
+        """
+        for resolution, rollup in self.rollups.items():
+            row = rollup.flush()
+            if row:
+                self.buffers[resolution].append(row)
+        for resolution in RESOLUTIONS:
+            self._flush(resolution)
+
+
+def pick_resolution(start, end):
+    for resolution, seconds in RESOLUTIONS.items():
+        if (end - start) / (seconds or float(os.getenv('MONITOR_INTERVAL', '2'))) <= max_points:
+            return resolution
+    return '1h'
+
+
+def _mapped(path):
+    try:
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):  # A missing or still empty file
+        return None
+
+
+def series_names(directory):
+    """Series of the most recent raw file."""
+    files = sorted(name for name in os.listdir(directory) if name.startswith('raw-')) if os.path.isdir(
+        directory) else []
+    if not files:
+        return []
+    buffer = _mapped(os.path.join(directory, files[-1]))
+    if buffer is None:
+        return []
+    with buffer:
+        names = set()
+        for _, columns in read_blocks(buffer, 0, 2 ** 62):
+            names.update(name for name in columns if name)
+        return sorted(names)
+
+
+def _merge_buckets(rows):
+    """Merge rollup rows of the same bucket, count weighted average, min of the minimums, max of the maximums."""
+    counts = rows.pop('count')
+    timestamps = rows['timestamps']
+    if len(set(timestamps)) == len(timestamps):
+        return rows
+    merged = {}
+    for timestamp, avg, minimum, maximum, count in zip(timestamps, rows['avg'], rows['min'], rows['max'], counts):
+        previous = merged.get(timestamp)
+        if previous is None:
+            merged[timestamp] = [avg * count, minimum, maximum, count]
+        else:
+            previous[0] += avg * count
+            previous[1] = min(previous[1], minimum)
+            previous[2] = max(previous[2], maximum)
+            previous[3] += count
+    ordered = sorted(merged.items())
+    return {
+        'timestamps': [timestamp for timestamp, _ in ordered],
+        'avg': [total / count for _, (total, _, _, count) in ordered],
+        'min': [minimum for _, (_, minimum, _, _) in ordered],
+        'max': [maximum for _, (_, _, maximum, _) in ordered],
+    }
+
+
+def query(directory, series, start, end, resolution='auto'):
+    """
+    Read series between two timestamps from the memory mapped archive files.
+
+    Args:
+        directory (str): The archive directory.
+        series (list): Series names, see `flatten`.
+        start (float): Seconds since the epoch.
+        end (float): Seconds since the epoch.
+        resolution (str): raw, 1m, 1h or auto.
+
+    Returns:
+        dict: The resolution used and per series the timestamps and values (raw) or avg/min/max (rollups),
+        NaN values are left out. Rollup rows written twice for the same bucket (around a restart) are merged.
+    """
+    if resolution == 'auto':
+        resolution = pick_resolution(start, end)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of auto, {', '.join(RESOLUTIONS)}")
+    fields = ('value',) if resolution == 'raw' else ('avg', 'min', 'max', 'count')
+    start_ms, end_ms = int(start * 1000), int(end * 1000)
+    result = {name: {'timestamps': [], **{field: [] for field in fields}} for name in series}
+
+    day = datetime.fromtimestamp(start, timezone.utc).date()
+    while day <= datetime.fromtimestamp(end, timezone.utc).date():
+        buffer = _mapped(file_path(directory, resolution, day.isoformat()))
+        day += timedelta(days=1)
+        if buffer is None:
+            continue
+        with buffer:
+            for rows, columns in read_blocks(buffer, start_ms, end_ms):
+                offset, length = columns['']
+                timestamps = decode_timestamps(buffer[offset:offset + length])
+                # Rows are in time order, only the blocks at both ends of the range are cut
+                low, high = bisect_left(timestamps, start_ms), bisect_right(timestamps, end_ms)
+                for name in series:
+                    decoded = {}
+                    for field in fields:
+                        column = columns.get(name if field == 'value' else f'{name}:{field}')
+                        if column:
+                            decoded[field] = decode_values(buffer[column[0]:column[0] + column[1]])[low:high]
+                    if fields[0] not in decoded:
+                        continue
+                    if 'count' in fields and 'count' not in decoded:
+                        decoded['count'] = [1.0] * (high - low)
+                    target = result[name]
+                    present = [i for i, value in enumerate(decoded[fields[0]]) if value == value]  # NaN != NaN
+                    if len(present) == high - low:
+                        target['timestamps'].extend(timestamp / 1000 for timestamp in timestamps[low:high])
+                        for field in fields:
+                            target[field].extend(decoded[field])
+                    else:
+                        target['timestamps'].extend(timestamps[low + i] / 1000 for i in present)
+                        for field in fields:
+                            target[field].extend(decoded[field][i] for i in present)
+    if resolution != 'raw':
+        for name in series:
+            result[name] = _merge_buckets(result[name])
+    return {'resolution': resolution, 'start': start, 'end': end, 'series': result}
@@ -0,0 +1,432 @@
+import asyncio
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import psutil
+
+from common import probes
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+_registry = {}
+
+
+def register(cls):
+    """Class decorator making a collector available by its name."""
+    _registry[cls.name] = cls
+    return cls
+
+
+def available():
+    return sorted(_registry)
+
+
+class Collector:
+    """
+    Base class of the collectors run by the Scheduler.
+
+    A collector returns a dict of raw numbers (bytes, percentages, seconds...) from `collect()`, formatting
+    is left to the API. `interval`, `timeout` and `enabled` can be overridden per collector with the
+    COLLECTOR_<NAME>_INTERVAL, COLLECTOR_<NAME>_TIMEOUT and COLLECTOR_<NAME>_ENABLED environment variables.
+    Expensive collectors are the first ones switched off when the process goes over its resource budget.
+    """
+
+    name = None
+    interval = 2.0
+    timeout = 10.0
+    expensive = False
+
+    def __init__(self, **options):
+        prefix = f'COLLECTOR_{self.name.upper()}_'
+        self.interval = float(os.getenv(prefix + 'INTERVAL', options.get('interval', self.interval)))
+        self.timeout = float(os.getenv(prefix + 'TIMEOUT', options.get('timeout', self.timeout)))
+        self.enabled = os.getenv(prefix + 'ENABLED', str(options.get('enabled', True))).lower() == 'true'
+
+    def setup(self):
+        """Called once before the first collection, e.g. to prime counters."""
+
+    def collect(self):
+        raise NotImplementedError
+
+
+class MetricsStore:
+    """Latest result of every collector."""
+
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def update(self, name, values=None, duration=0.0, error=None):
+        with self.lock:
+            previous = self.results.get(name, {})
+            self.results[name] = {
+                # A failed run keeps the last good values, with the error next to them
+                'values': values if error is None else previous.get('values'),
+                'timestamp': time.time() if error is None else previous.get('timestamp'),
+                'duration': round(duration, 4),
+                'error': error,
+            }
+
+    def values(self, name):
+        with self.lock:
+            result = self.results.get(name)
+            return result['values'] if result else None
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(result) for name, result in self.results.items()}
+
+
+class Scheduler:
+    """
+    Runs every collector at its own interval on a small thread pool, embedded in app.py or as the
+    network_monitor.py daemon. All collector intervals are stretched when the SelfMonitor raises the
+    loop interval, and expensive collectors are skipped while it has them disabled.
+    """
+
+    def __init__(self, collectors, monitor, store=None, workers=4, on_tick=None):
+        self.collectors = [collector for collector in collectors if collector.enabled]
+        self.monitor = monitor
+        self.store = store or MetricsStore()
+        self.on_tick = on_tick
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='collector')
+        self.next_run = {}
+        self.running = {}  # name -> (future, started)
+        self._thread = None
+
+    @staticmethod
+    def _timed(collector):
+        """Run collector.collect() in a worker, timed there so the duration excludes the wait for the next tick."""
+        started = time.monotonic()
+        try:
+            return collector.collect(), time.monotonic() - started, None
+        except Exception as e:
+            return None, time.monotonic() - started, e
+
+    def _finish(self, collector, future):
+        values, duration, error = future.result()
+        if error is None:
+            self.store.update(collector.name, values, duration)
+        else:
+            logger.warning(f"Collector {collector.name} failed: {error}")
+            self.store.update(collector.name, duration=duration, error=str(error))
+
+    def tick(self):
+        """Start the collectors that are due and record the ones that finished, without waiting for the others."""
+        now = time.monotonic()
+        stretch = self.monitor.interval / self.monitor.base_interval
+        for collector in self.collectors:
+            running = self.running.get(collector.name)
+            if running:
+                future, started = running
+                if not future.done():
+                    if now - started > collector.timeout:
+                        # A thread can not be killed, the collector is simply not started again until it returns
+                        self.store.update(collector.name, duration=now - started,
+                                          error=f"timed out after {collector.timeout}s")
+                    continue
+                # Finished since the last tick, record it and start it again below when it is due
+                del self.running[collector.name]
+                self._finish(collector, future)
+            if collector.expensive and not self.monitor.expensive_enabled:
+                continue
+            # Half a tick of slack, a collector running at the loop interval must not slip to every other tick
+            if now + self.monitor.interval / 2 >= self.next_run.get(collector.name, 0):
+                self.next_run[collector.name] = now + collector.interval * stretch
+                self.running[collector.name] = (self.executor.submit(self._timed, collector), now)
+
+        # Collectors that already returned are recorded within this tick, the others on a later one
+        for name, (future, _) in list(self.running.items()):
+            if future.done():
+                del self.running[name]
+                self._finish(next(c for c in self.collectors if c.name == name), future)
+
+    def run_forever(self):
+        for collector in self.collectors:
+            try:
+                collector.setup()
+            except Exception as e:
+                logger.warning(f"Collector {collector.name} setup failed: {e}")
+        while True:
+            self.monitor.wait()
+            self.monitor.start_iteration()
+            self.tick()
+            self.monitor.end_iteration()
+            if self.on_tick:
+                try:
+                    self.on_tick(self)
+                except Exception as e:
+                    logger.error(f"Collector tick callback failed: {e}")
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Run the scheduler in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever, name='collector-scheduler', daemon=True)
+            self._thread.start()
+
+
+def create(names, **options):
+    """
+    Instantiate the named collectors.
+
+    Args:
+        names (list): Collector names, unknown ones are logged and skipped.
+        options: Extra keyword arguments, passed to the collectors accepting them.
+    """
+    collectors = []
+    for name in names:
+        cls = _registry.get(name.strip())
+        if cls is None:
+            logger.warning(f"Unknown collector: {name}")
+            continue
+        collectors.append(cls(**options))
+    return collectors
+
+
+@register
+class SystemCollector(Collector):
+    name = 'system'
+    interval = 2.0
+
+    def setup(self):
+        psutil.cpu_percent(interval=None)  # Prime the system wide cpu percentage
+
+    def collect(self):
+        # Non blocking, the percentage is computed since the previous call (one interval ago)
+        return {
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory_percent': psutil.virtual_memory().percent,
+        }
+
+
+@register
+class NetworkCollector(Collector):
+    name = 'network'
+    interval = 2.0
+
+    def setup(self):
+        counters = psutil.net_io_counters()
+        self.initial_sent, self.initial_recv = counters.bytes_sent, counters.bytes_recv
+        self.prev_sent, self.prev_recv = self.initial_sent, self.initial_recv
+        self.prev_time = time.monotonic()
+
+    def collect(self):
+        counters = psutil.net_io_counters()
+        now = time.monotonic()
+        elapsed = max(now - self.prev_time, 1e-6)
+        values = {
+            'upload_bytes_per_second': (counters.bytes_sent - self.prev_sent) / elapsed,
+            'download_bytes_per_second': (counters.bytes_recv - self.prev_recv) / elapsed,
+            'instance_total_upload': counters.bytes_sent - self.initial_sent,
+            'instance_total_download': counters.bytes_recv - self.initial_recv,
+        }
+        self.prev_sent, self.prev_recv, self.prev_time = counters.bytes_sent, counters.bytes_recv, now
+        return values
+
+
+def get_instance_id():
+    try:
+        # Determine the OS type
+        os_type = platform.system()
+
+        # Use the appropriate command based on the OS
+        if os_type == "Linux":
+            # Check if it's Amazon Linux (AMI)
+            with open('/etc/os-release') as f:
+                os_release = f.read()
+            if 'Amazon Linux' in os_release:
+                command = 'ec2-metadata'
+            else:  # Assume Ubuntu for other Linux distributions
+                command = 'ec2metadata'
+
+            # Run the command
+            result = subprocess.run([command, '--instance-id'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    text=True)
+
+            if result.returncode == 0:
+                return result.stdout.strip().split(": ")[1] if command == 'ec2-metadata' else result.stdout.strip()
+            else:
+                logger.error(f"Error fetching instance ID: {result.stderr}")
+                return None
+        else:
+            logger.error(f"Unsupported OS: {os_type}")
+            return None
+
+    except Exception as e:
+        logger.error(f"Unable to fetch instance ID: {e}")
+        return None
+
+
+def get_billing_period():
+    """Get the current AWS billing period."""
+    now = datetime.now(timezone.utc)
+    start = datetime(now.year, now.month, 1)
+    end = start + timedelta(days=32)
+    end = datetime(end.year, end.month, 1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+@register
+class AwsBandwidthCollector(Collector):
+    # IMPORTANT: To Access cloud watch setup the IAM role using below steps
+    # Create an IAM Role:
+    # Go to AWS Management Console:
+    # Navigate to the IAM (Identity and Access Management) service.
+    # Select "Roles" from the sidebar.
+    # Click "Create role."
+    # Select EC2 Service:
+    # Choose the "AWS service" type and select "EC2" as the service that will use this role.
+    # Attach Policies:
+    # Attach the necessary policies to your role (e.g., CloudWatchReadOnlyAccess, AmazonS3ReadOnlyAccess, etc.).
+    # Name and Create Role:
+    # Provide a name for your role (e.g., MyEC2Role) and create it.
+    # Attach the IAM Role to Your EC2 Instance:
+    # Go to EC2 Dashboard:
+    # Navigate to the EC2 Dashboard in the AWS Management Console.
+    # Select Your Instance:
+    # Choose the EC2 instance where you want to attach the IAM role.
+    # Actions > Security > Modify IAM Role:
+    # Click on "Actions" > "Security" > "Modify IAM Role."
+    # Attach Role:
+    # Select the IAM role you created and attach it to your instance.
+    """Get AWS EC2 instance bandwidth usage for the current billing period."""
+
+    name = 'aws_bandwidth'
+    interval = 600.0
+    timeout = 60.0
+    expensive = True
+
+    def __init__(self, instance_id=None, **options):
+        super().__init__(**options)
+        self.instance_id = instance_id
+
+    def setup(self):
+        import boto3  # Only import boto3 if running on EC2
+        self.cloudwatch = boto3.client('cloudwatch', 'us-east-1')
+
+    def get_metric_sum(self, metric_name):
+        start, end = get_billing_period()
+        response = self.cloudwatch.get_metric_statistics(
+            Namespace='AWS/EC2',
+            MetricName=metric_name,
+            Dimensions=[
+                {
+                    'Name': 'InstanceId',
+                    'Value': self.instance_id
+                },
+            ],
+            StartTime=start,
+            EndTime=end,
+            Period=86400,
+            Statistics=['Sum'],
+            Unit='Bytes'
+        )
+        data_points = response['Datapoints']
+        return sum(dp['Sum'] for dp in data_points)
+
+    def collect(self):
+        network_in = self.get_metric_sum('NetworkIn')
+        network_out = self.get_metric_sum('NetworkOut')
+        return {'network_in': network_in, 'network_out': network_out, 'total_bandwidth': network_in + network_out}
+
+
+@register
+class DiskCollector(Collector):
+    name = 'disk'
+    interval = 30.0
+
+    # Host filesystems as mounted into the server_setup container
+    drive_labels = {
+        '/host_fs': 'OS Partition',
+        '/host_fs/home': 'Home Partition',
+        '/host_fs/mnt/newdrive': 'New Drive'
+    }
+
+    def collect(self):
+        partitions = []
+        seen = set()
+        for part in psutil.disk_partitions():
+            if part.mountpoint in self.drive_labels and part.mountpoint not in seen:
+                seen.add(part.mountpoint)
+                usage = psutil.disk_usage(part.mountpoint)
+                partitions.append({
+                    'label': self.drive_labels[part.mountpoint],
+                    'mountpoint': part.mountpoint,
+                    'total': usage.total,
+                    'used': usage.used,
+                    'free': usage.free,
+                    'percent': usage.percent,
+                })
+        return {'partitions': partitions}
+
+
+def container_usage(container_stats):
+    """CPU and memory percentages from one `docker stats` sample."""
+    cpu_stats = container_stats['cpu_stats']
+    precpu_stats = container_stats['precpu_stats']
+    cpu_usage = cpu_stats['cpu_usage']
+    percpu_usage = cpu_usage.get('percpu_usage', [cpu_usage['total_usage']])
+
+    if 'system_cpu_usage' in cpu_stats and 'system_cpu_usage' in precpu_stats:
+        cpu_delta = cpu_usage['total_usage'] - precpu_stats['cpu_usage']['total_usage']
+        system_cpu_delta = cpu_stats['system_cpu_usage'] - precpu_stats['system_cpu_usage']
+        number_cpus = cpu_stats.get('online_cpus') or len(percpu_usage)
+        cpu_percent = (cpu_delta / system_cpu_delta) * number_cpus * 100.0 if system_cpu_delta > 0 else 0.0
+    else:
+        cpu_percent = 0.0
+
+    memory_stats = container_stats['memory_stats']
+    memory_usage = (memory_stats['usage'] / memory_stats['limit']) * 100.0 if memory_stats.get('limit') else 0.0
+    return cpu_percent, memory_usage
+
+
+@register
+class DockerStatsCollector(Collector):
+    name = 'docker'
+    interval = 10.0
+    timeout = 30.0
+    expensive = True  # One stats round trip per container
+
+    def collect(self):
+        from common.docker_inventory import inventory
+
+        containers = []
+        for container in inventory.running():
+            cpu_percent, memory_percent = container_usage(container.stats(stream=False))
+            containers.append({'name': container.name, 'cpu_percent': cpu_percent,
+                               'memory_percent': memory_percent})
+        return {'containers': containers}
+
+
+@register
+class ProbeCollector(Collector):
+    """TCP connect and ICMP echo round trips to PROBE_TARGETS, probed concurrently on one asyncio event loop."""
+
+    name = 'probe'
+    interval = 10.0
+    timeout = 15.0
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.targets = probes.parse_targets(os.getenv('PROBE_TARGETS', probes.default_targets))
+        self.icmp = None
+        self.sequence = 0
+        self.loop = None
+
+    def collect(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.icmp = probes.icmp_permitted()
+        self.sequence = (self.sequence + 1) % 65536
+        self.loop.run_until_complete(probes.probe_all(self.targets, probes.probe_timeout, self.icmp, self.sequence))
+        return {'icmp_permitted': self.icmp, 'targets': [probes.summarize(target) for target in self.targets]}
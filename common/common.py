@@ -1,7 +1,9 @@
 import fcntl
 import json
 import logging
+import math
 import os
+import tempfile
 from datetime import datetime
 
 # Global variable to store the start time of the service
@@ -45,3 +47,45 @@ def parse_status_file(file_path):
         return f"Error parsing JSON in {file_path}: {e}"
 
     return data
+
+
+def convert_size(size_bytes):
+    """
+    Convert bytes to a human-readable format (KB, MB, GB, TB).
+
+    Args:
+        size_bytes (int): The size in bytes.
+
+    Returns:
+        str: The human-readable size.
+    """
+    if size_bytes is None or size_bytes < 0:
+        return "Invalid size"
+    if size_bytes < 1:
+        return "0 B"
+
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = min(int(math.floor(math.log(size_bytes, 1024))), len(size_name) - 1)
+    p = math.pow(1024, i)
+    s = size_bytes / p
+
+    return f"{s:.2f} {size_name[i]}"
+
+
+def write_json(file_path, data):
+    """
+    Write a JSON file atomically, readers of parse_status_file see either the old or the new content.
+
+    Args:
+        file_path (str): The file to write.
+        data: The JSON serializable content.
+    """
+    directory = os.path.dirname(file_path) or '.'
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=4)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
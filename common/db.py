@@ -0,0 +1,118 @@
+import logging
+import os
+import queue
+import re
+import threading
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+db_host = os.getenv('DB_HOST', 'mariadb')
+db_port = int(os.getenv('DB_PORT', '3306'))
+
+_IDENTIFIER = re.compile(r'^[A-Za-z0-9_$]+$')
+
+
+class ConnectionPool:
+    """Small pool of root connections to MariaDB, pymysql is only imported when a connection is needed."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self.connections = queue.LifoQueue(maxsize=size)
+        self.password = None
+        self.lock = threading.Lock()
+
+    def _connect(self, password):
+        import pymysql  # Only needed when credentials change
+        return pymysql.connect(host=db_host, port=db_port, user='root', password=password, autocommit=True,
+                               connect_timeout=5)
+
+    def acquire(self, password):
+        """
+        Return a connection for the root user, reusing a pooled one when it is still alive.
+
+        Args:
+            password (str): The current root password, a different one drops the pooled connections.
+        """
+        with self.lock:
+            if password != self.password:
+                self.clear()
+                self.password = password
+        while True:
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                return self._connect(password)
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except Exception:
+                connection.close()
+
+    def release(self, connection):
+        try:
+            self.connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def clear(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+            except Exception:
+                continue
+
+
+pool = ConnectionPool()
+
+
+def apply_credentials(old_env, new_env, changed):
+    """
+    Apply changed MYSQL_* variables to the running MariaDB instead of restarting it.
+
+    The MariaDB image only reads these variables when it initializes an empty data directory,
+    so a restart would not apply them anyway; this runs the equivalent statements live.
+
+    Returns:
+        list: A description of every statement that was run.
+    """
+    root_password = old_env.get('MYSQL_ROOT_PASSWORD') or new_env.get('MYSQL_ROOT_PASSWORD')
+    user = new_env.get('MYSQL_USER')
+    database = new_env.get('MYSQL_DATABASE')
+    if database and not _IDENTIFIER.match(database):
+        raise ValueError(f"Invalid database name: {database}")
+
+    statements = []
+    if 'MYSQL_DATABASE' in changed and database:
+        statements.append((f"CREATE DATABASE IF NOT EXISTS `{database}`", (), f"create database {database}"))
+    if user and {'MYSQL_USER', 'MYSQL_PASSWORD'} & changed:
+        password = new_env.get('MYSQL_PASSWORD', '')
+        statements.append(("CREATE USER IF NOT EXISTS %s@'%%' IDENTIFIED BY %s", (user, password),
+                           f"create user {user}"))
+        statements.append(("ALTER USER %s@'%%' IDENTIFIED BY %s", (user, password), f"set password of {user}"))
+    if user and database and {'MYSQL_USER', 'MYSQL_DATABASE'} & changed:
+        statements.append((f"GRANT ALL PRIVILEGES ON `{database}`.* TO %s@'%%'", (user,),
+                           f"grant {database} to {user}"))
+    if 'MYSQL_ROOT_PASSWORD' in changed:
+        # Last, so the statements above still run with the old root password
+        for host in ('%', 'localhost'):
+            statements.append(("ALTER USER IF EXISTS 'root'@%s IDENTIFIED BY %s",
+                               (host, new_env['MYSQL_ROOT_PASSWORD']), f"set root password for {host}"))
+    if not statements:
+        return []
+
+    connection = pool.acquire(root_password)
+    try:
+        with connection.cursor() as cursor:
+            for sql, params, description in statements:
+                cursor.execute(sql, params)
+                logger.info(f"Applied to MariaDB: {description}")
+    except Exception:
+        connection.close()
+        raise
+    pool.release(connection)
+    if 'MYSQL_ROOT_PASSWORD' in changed:
+        pool.clear()
+    return [description for _, _, description in statements]
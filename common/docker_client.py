@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# Docker (and the requests stack it pulls in) is only imported on first use, so the API can start serving
+# /monitor/health before the Docker socket answers.
+_client = None
+_client_lock = threading.Lock()
+_last_error = None
+_last_attempt = 0.0
+_retry_delay = 1.0
+_MAX_RETRY_DELAY = 30.0
+
+
+class DockerUnavailable(Exception):
+    """Raised when the Docker daemon could not be reached (yet)."""
+
+
+def __getattr__(name):
+    # Lazily expose the docker.errors exceptions (DockerException, NotFound, APIError...) so callers
+    # can write `except docker_client.NotFound` without importing docker at startup.
+    if name[:1].isupper():
+        import docker.errors
+        if hasattr(docker.errors, name):
+            return getattr(docker.errors, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _connect():
+    global _client, _last_error, _last_attempt, _retry_delay
+    import docker
+
+    _last_attempt = time.monotonic()
+    try:
+        _client = docker.from_env()
+        _last_error = None
+        _retry_delay = 1.0
+        logger.info("Connected to the Docker daemon")
+    except docker.errors.DockerException as e:
+        _last_error = str(e)
+        _retry_delay = min(_retry_delay * 2, _MAX_RETRY_DELAY)
+        logger.warning(f"Docker daemon not available, retrying in {_retry_delay}s: {e}")
+
+
+def get_client():
+    """
+    Return the shared Docker client, creating it on first use.
+
+    Failed connections are retried with an exponential backoff, requests made while
+    waiting for the next attempt fail fast instead of hanging on the socket.
+
+    Returns:
+        docker.DockerClient: The connected client.
+
+    Raises:
+        DockerUnavailable: If the Docker daemon can not be reached.
+    """
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None and (_last_attempt == 0.0 or time.monotonic() - _last_attempt >= _retry_delay):
+            _connect()
+        if _client is None:
+            raise DockerUnavailable(f"Docker daemon not available: {_last_error}")
+        return _client
+
+
+def is_ready():
+    return _client is not None
+
+
+def status():
+    return {'connected': _client is not None, 'last_error': _last_error}
@@ -0,0 +1,294 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from common import docker_client
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+df_ttl = float(os.getenv('DOCKER_DF_TTL', '300'))
+keep_versions_default = int(os.getenv('PRUNE_KEEP_VERSIONS', '3'))
+max_age_days_default = float(os.getenv('PRUNE_MAX_AGE_DAYS', '14'))
+# Automatic pruning is off unless an interval is configured
+prune_interval_hours = float(os.getenv('PRUNE_INTERVAL_HOURS', '0'))
+
+
+def _parse_time(value):
+    """Docker returns RFC 3339 timestamps with nanoseconds, Python only parses microseconds."""
+    if not value:
+        return 0.0
+    value = value.replace('Z', '+00:00')
+    if '.' in value:
+        head, rest = value.split('.', 1)
+        digits = ''.join(c for c in rest if c.isdigit())
+        value = f"{head}.{digits[:6].ljust(6, '0')}{rest[len(digits):]}"
+    return datetime.fromisoformat(value).timestamp()
+
+
+def _project(labels):
+    """The compose project and service an image was built for, compose labels the images it builds."""
+    project = labels.get('com.docker.compose.project')
+    service = labels.get('com.docker.compose.service')
+    return f"{project}/{service}" if project and service else None
+
+
+def summarize(df):
+    """
+    Reduce the raw `docker system df` output to per image, volume and build cache usage.
+
+    Returns:
+        dict: Sizes in bytes, with totals and the space that could be reclaimed.
+    """
+    images = [{
+        'id': image['Id'],
+        'tags': image.get('RepoTags') or [],
+        'created': image.get('Created', 0),
+        'size': image.get('Size', 0),
+        'shared_size': max(image.get('SharedSize', 0), 0),
+        'containers': image.get('Containers', 0),
+        'project': _project(image.get('Labels') or {}),
+    } for image in df.get('Images') or []]
+    volumes = [{
+        'name': volume['Name'],
+        'size': volume.get('UsageData', {}).get('Size', 0),
+        'ref_count': volume.get('UsageData', {}).get('RefCount', 0),
+    } for volume in df.get('Volumes') or []]
+    build_cache = [{
+        'id': entry['ID'],
+        'type': entry.get('Type'),
+        'size': entry.get('Size', 0),
+        'in_use': entry.get('InUse', False),
+        'shared': entry.get('Shared', False),
+        'last_used': _parse_time(entry.get('LastUsedAt') or entry.get('CreatedAt')),
+    } for entry in df.get('BuildCache') or []]
+
+    unused_images = [image for image in images if image['containers'] <= 0]
+    return {
+        'images': images,
+        'volumes': volumes,
+        'build_cache': build_cache,
+        'totals': {
+            'layers_size': df.get('LayersSize', 0),
+            'images': sum(image['size'] - image['shared_size'] for image in images),
+            'volumes': sum(max(volume['size'], 0) for volume in volumes),
+            'build_cache': sum(entry['size'] for entry in build_cache if not entry['shared']),
+        },
+        'reclaimable': {
+            'dangling_images': sum(image['size'] - image['shared_size'] for image in unused_images
+                                   if not image['tags'] or image['tags'] == ['<none>:<none>']),
+            'unused_images': sum(image['size'] - image['shared_size'] for image in unused_images),
+            'unused_volumes': sum(max(volume['size'], 0) for volume in volumes if volume['ref_count'] == 0),
+            'build_cache': sum(entry['size'] for entry in build_cache if not entry['in_use'] and not entry['shared']),
+        },
+    }
+
+
+class DiskUsage:
+    """
+    `docker system df` can take seconds (or minutes on a busy daemon), so it is only ever run in a
+    background thread and its summary cached for `df_ttl` seconds. Readers get the cached value
+    immediately, a stale one triggers a refresh for the next reader.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.summary = None
+        self.updated = 0.0
+        self.duration = 0.0
+        self.error = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def _refresh(self):
+        start = time.monotonic()
+        try:
+            summary = summarize(docker_client.get_client().df())
+            with self.lock:
+                self.summary, self.updated, self.error = summary, time.time(), None
+        except Exception as e:
+            logger.warning(f"Docker disk usage refresh failed: {e}")
+            with self.lock:
+                self.error = str(e)
+        finally:
+            with self.lock:
+                self.duration = time.monotonic() - start
+                self.refreshing = False
+
+    def refresh(self):
+        """Start a background refresh unless one is already running."""
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh, name='docker-df', daemon=True).start()
+
+    def get(self):
+        """
+        Return the cached summary without blocking.
+
+        Returns:
+            dict: The summary (None until the first refresh finished) with its age and refresh state.
+        """
+        with self.lock:
+            stale = time.time() - self.updated > self.ttl
+            result = {
+                'usage': self.summary,
+                'age_seconds': round(time.time() - self.updated, 1) if self.summary else None,
+                'refresh_seconds': round(self.duration, 2),
+                'refreshing': self.refreshing or stale,
+                'error': self.error,
+            }
+        if stale:
+            self.refresh()
+        return result
+
+
+def plan_prune(summary, keep_versions, max_age_days, build_cache=True):
+    """
+    Decide what the pruning policy would remove.
+
+    Per repository the newest `keep_versions` images are always kept, older ones are removed once they
+    are older than `max_age_days` and not used by any container. An untagged image built by compose (the
+    previous version of a rebuilt service) counts as a version of the repository tagged for the same
+    project and service. Other dangling images, and build cache entries not used for `max_age_days`, are
+    removed once older than `max_age_days`. Volumes are never pruned.
+
+    Returns:
+        dict: The images and build cache entries to remove and the bytes that would be reclaimed.
+    """
+    cutoff = time.time() - max_age_days * 86400
+    by_repository = defaultdict(list)
+    project_repository = {}  # compose project/service -> repository of its tagged image
+    untagged = []
+    for image in summary['images']:
+        tags = [tag for tag in image['tags'] if tag != '<none>:<none>']
+        if tags:
+            repository = tags[0].rsplit(':', 1)[0]
+            by_repository[repository].append(image)
+            if image.get('project'):
+                project_repository[image['project']] = repository
+        else:
+            untagged.append(image)
+    images = []
+    for image in untagged:
+        if image.get('project'):
+            by_repository[project_repository.get(image['project'], image['project'])].append(image)
+        elif image['containers'] <= 0 and image['created'] < cutoff:
+            images.append(image)  # Dangling
+    for repository_images in by_repository.values():
+        # Images in use count towards the kept versions but are never removed
+        repository_images.sort(key=lambda image: image['created'], reverse=True)
+        images.extend(image for image in repository_images[keep_versions:]
+                      if image['created'] < cutoff and image['containers'] <= 0)
+
+    cache = [entry for entry in summary['build_cache']
+             if build_cache and not entry['in_use'] and entry['last_used'] < cutoff]
+    return {
+        'images': [{'id': image['id'], 'tags': image['tags'], 'size': image['size'] - image['shared_size']}
+                   for image in images],
+        'build_cache': [{'id': entry['id'], 'size': entry['size']} for entry in cache],
+        'reclaimable_bytes': (sum(image['size'] - image['shared_size'] for image in images)
+                              + sum(entry['size'] for entry in cache if not entry['shared'])),
+    }
+
+
+class PruneJobs:
+    """Runs pruning in a background thread, one job at a time, and keeps the reports of recent jobs."""
+
+    def __init__(self, disk_usage, history=20):
+        self.disk_usage = disk_usage
+        self.history = history
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.running = None
+
+    def start(self, dry_run=True, keep_versions=keep_versions_default, max_age_days=max_age_days_default,
+              build_cache=True):
+        """
+        Queue a prune job.
+
+        Returns:
+            dict: The job, or None if another job is still running.
+        """
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'status': 'running',
+            'dry_run': dry_run,
+            'policy': {'keep_versions': keep_versions, 'max_age_days': max_age_days, 'build_cache': build_cache},
+            'started': time.time(),
+            'finished': None,
+            'plan': None,
+            'removed_bytes': 0,
+            'errors': [],
+        }
+        with self.lock:
+            if self.running:
+                return None
+            self.running = job['id']
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.history:
+                self.jobs.pop(next(iter(self.jobs)))
+        threading.Thread(target=self._run, args=(job,), name='docker-prune', daemon=True).start()
+        return job
+
+    def _run(self, job):
+        try:
+            # Plan on fresh numbers, an old df could point at images that are in use by now
+            summary = summarize(docker_client.get_client().df())
+            plan = plan_prune(summary, **job['policy'])
+            job['plan'] = plan
+            if not job['dry_run']:
+                self._apply(job, plan)
+            job['status'] = 'done'
+        except Exception as e:
+            logger.error(f"Prune job {job['id']} failed: {e}")
+            job['status'] = 'failed'
+            job['errors'].append(str(e))
+        finally:
+            job['finished'] = time.time()
+            with self.lock:
+                self.running = None
+            self.disk_usage.refresh()
+
+    def _apply(self, job, plan):
+        client = docker_client.get_client()
+        for image in plan['images']:
+            try:
+                client.images.remove(image['id'])
+                job['removed_bytes'] += image['size']
+            except docker_client.APIError as e:
+                # Usually an image a container started using since the plan was made
+                job['errors'].append(f"{image['tags'] or image['id']}: {e.explanation}")
+        if plan['build_cache']:
+            hours = int(job['policy']['max_age_days'] * 24)
+            # all=True removes every unused entry, not only the dangling ones, matching what plan_prune counted
+            result = client.api.prune_builds(filters={'until': f'{hours}h'}, all=True)
+            job['removed_bytes'] += result.get('SpaceReclaimed') or 0
+        logger.info(f"Prune job {job['id']} reclaimed {job['removed_bytes']} bytes")
+
+    def schedule(self, interval_hours):
+        """Run a (non dry run) prune job with the default policy every `interval_hours`."""
+        def run():
+            while True:
+                time.sleep(interval_hours * 3600)
+                if self.start(dry_run=False) is None:
+                    logger.info("Skipping the scheduled prune, a prune job is already running")
+
+        threading.Thread(target=run, name='docker-prune-schedule', daemon=True).start()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+
+disk_usage = DiskUsage(df_ttl)
+prune_jobs = PruneJobs(disk_usage)
@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from common import docker_client
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+reconcile_interval = float(os.getenv('DOCKER_RECONCILE_INTERVAL', '60'))
+event_log_size = int(os.getenv('DOCKER_EVENT_LOG_SIZE', '1000'))
+
+# Container actions that change what we know about a container, anything else (exec, attach...) is only logged
+_REFRESH_ACTIONS = {'create', 'start', 'restart', 'stop', 'die', 'kill', 'pause', 'unpause', 'rename', 'update',
+                    'oom', 'health_status'}
+
+
+class ContainerInventory:
+    """
+    In-process view of all containers, kept current from the Docker events stream.
+
+    A full `containers.list(all=True)` is only done at startup, after the events stream reconnects and
+    every `reconcile_interval` seconds to heal missed events. Everything else reads from memory.
+    """
+
+    def __init__(self):
+        self.containers = {}  # name -> docker Container
+        self.events = deque(maxlen=event_log_size)
+        self.lock = threading.Lock()
+        self.synced = False
+        self.last_reconcile = 0.0
+        self.reconciles = 0
+        self.events_seen = 0
+        self._thread = None
+
+    def reconcile(self):
+        """Replace the inventory with a fresh listing from the daemon."""
+        containers = docker_client.get_client().containers.list(all=True)
+        with self.lock:
+            self.containers = {container.name: container for container in containers}
+            self.synced = True
+            self.last_reconcile = time.time()
+            self.reconciles += 1
+
+    def ensure_synced(self):
+        if not self.synced:
+            self.reconcile()
+
+    def get(self, name):
+        """
+        Return a container by name.
+
+        Returns:
+            docker.models.containers.Container: The container, or None if there is no such container.
+        """
+        self.ensure_synced()
+        with self.lock:
+            return self.containers.get(name)
+
+    def running(self):
+        self.ensure_synced()
+        with self.lock:
+            return [container for container in self.containers.values() if container.status == 'running']
+
+    def all(self):
+        self.ensure_synced()
+        with self.lock:
+            return list(self.containers.values())
+
+    def using_env(self, env, keys):
+        """
+        Containers that were created with one of `keys` set to its value in `env`.
+
+        Env files are only read when a container is created, so these are exactly the containers
+        that hold a stale copy of a changed variable. A key missing from `env` (newly added) matches
+        every container created from that env file, recognized by holding any of its variables.
+        """
+        pairs = {f'{key}={env[key]}' for key in keys if key in env}
+        if any(key not in env for key in keys):
+            pairs |= {f'{key}={value}' for key, value in env.items()}
+        return [container for container in self.all()
+                if pairs & set(container.attrs.get('Config', {}).get('Env') or [])]
+
+    def _apply(self, event):
+        action = event.get('Action', '').split(':')[0]
+        actor = event.get('Actor', {})
+        container_id = actor.get('ID') or event.get('id')
+        name = actor.get('Attributes', {}).get('name')
+        with self.lock:
+            self.events.append({
+                'time': event.get('timeNano', event.get('time', 0) * 10 ** 9) / 10 ** 9,
+                'action': event.get('Action'),
+                'id': container_id,
+                'name': name,
+                'image': actor.get('Attributes', {}).get('image'),
+            })
+            self.events_seen += 1
+
+        if action == 'destroy':
+            with self.lock:
+                for key, container in list(self.containers.items()):
+                    if container.id == container_id:
+                        del self.containers[key]
+        elif action in _REFRESH_ACTIONS:
+            try:
+                container = docker_client.get_client().containers.get(container_id)
+            except docker_client.NotFound:
+                return
+            with self.lock:
+                # A rename leaves the old name behind
+                for key, existing in list(self.containers.items()):
+                    if existing.id == container.id and key != container.name:
+                        del self.containers[key]
+                self.containers[container.name] = container
+
+    def _run(self):
+        backoff = 1
+        while True:
+            try:
+                client = docker_client.get_client()
+                # Events are requested from before the listing, so nothing between the two is missed
+                since = int(time.time())
+                self.reconcile()
+                events = client.events(decode=True, filters={'type': 'container'}, since=since,
+                                       until=since + int(reconcile_interval))
+                for event in events:
+                    self._apply(event)
+                backoff = 1
+            except Exception as e:
+                logger.warning(f"Docker events stream failed, reconnecting in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def start(self):
+        """Follow the events stream in the background."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='docker-events', daemon=True)
+            self._thread.start()
+
+    def events_since(self, since=0.0):
+        with self.lock:
+            return [event for event in self.events if event['time'] > since]
+
+    def status(self):
+        with self.lock:
+            return {
+                'synced': self.synced,
+                'containers': len(self.containers),
+                'last_reconcile': self.last_reconcile,
+                'reconciles': self.reconciles,
+                'events_seen': self.events_seen,
+            }
+
+
+inventory = ContainerInventory()
@@ -0,0 +1,103 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# flock only serializes between processes, this one serializes the request threads of this process
+_thread_lock = threading.Lock()
+
+
+def parse_env(content):
+    """
+    Parse the KEY=value lines of an env file, keeping their order.
+
+    Args:
+        content (str): The content of the env file.
+
+    Returns:
+        dict: The variables, comments and blank lines are skipped.
+    """
+    env = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if line and not line.startswith('#') and '=' in line:
+            key, value = line.split('=', 1)
+            env[key.strip()] = value
+    return env
+
+
+def read_env(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return parse_env(file.read())
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock for `path`, on a sidecar file since the env file itself gets replaced."""
+    with _thread_lock:
+        with open(f'{path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_env_atomic(path, env):
+    """
+    Replace the env file in one step: write a temporary file next to it, fsync it and rename it over the old one,
+    so readers (and a crash half way) only ever see the complete old or the complete new file.
+    """
+    directory = os.path.dirname(path) or '.'
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o600
+    fd, temp_path = tempfile.mkstemp(prefix='.env.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            for key, value in env.items():
+                file.write(f'{key}={value}\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    # Persist the rename itself
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def update_env(path, updates, before_write=None):
+    """
+    Apply `updates` to the env file under a lock and report what actually changed.
+
+    Args:
+        path (str): The env file.
+        updates (dict): The new values, keys with the same value as before are ignored.
+        before_write (callable): Called with (old_env, new_env, changed) under the lock before the file is replaced,
+            when it raises the file is left untouched, so a retry sees the same changes again.
+
+    Returns:
+        tuple: The previous variables, the new variables and the set of changed keys.
+    """
+    with locked(path):
+        old_env = read_env(path)
+        new_env = dict(old_env)
+        new_env.update(updates)
+        changed = {key for key in updates if old_env.get(key) != new_env[key]}
+        if changed:
+            if before_write:
+                before_write(old_env, new_env, changed)
+            write_env_atomic(path, new_env)
+            logger.info(f"Updated {path}: {', '.join(sorted(changed))}")
+    return old_env, new_env, changed
@@ -0,0 +1,287 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+hls_dir = os.getenv('RESTREAM_HLS_DIR', '/tmp/restream-hls')
+segment_seconds = int(os.getenv('HLS_SEGMENT_SECONDS', '4'))
+playlist_size = int(os.getenv('HLS_PLAYLIST_SIZE', '30'))
+idle_timeout = float(os.getenv('HLS_IDLE_TIMEOUT', '60'))
+memory_cache_bytes = int(os.getenv('HLS_MEMORY_CACHE_MB', '64')) * 1024 * 1024
+disk_cache_bytes = int(os.getenv('HLS_DISK_CACHE_MB', '1024')) * 1024 * 1024
+
+PLAYLIST_NAME = 'index.m3u8'
+_SAFE_NAME = re.compile(r'^[\w-]+(\.ts|\.m3u8)?$')
+
+
+def is_safe_name(name):
+    """Stream ids and segment names end up in file paths, only allow plain names."""
+    return bool(_SAFE_NAME.match(name)) and name not in ('.', '..')
+
+
+class SegmentCache:
+    """
+    Two tier LRU cache of the HLS segments written by ffmpeg.
+
+    Every segment on disk is tracked in a disk LRU bounded by `disk_limit` bytes, the most recently
+    served ones are also kept in memory up to `memory_limit` bytes. Segments still listed in a live
+    playlist are never removed from disk.
+    """
+
+    def __init__(self, memory_limit, disk_limit):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()  # path -> bytes
+        self.disk = OrderedDict()  # path -> size
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def track(self, path, size):
+        """Register a segment that appeared on disk."""
+        with self.lock:
+            if path not in self.disk:
+                self.disk[path] = size
+                self.disk_bytes += size
+
+    def get(self, path):
+        """
+        Return the content of a segment, from memory when possible.
+
+        Returns:
+            bytes: The segment, or None if it is not on disk (anymore).
+        """
+        with self.lock:
+            data = self.memory.get(path)
+            if data is not None:
+                self.memory.move_to_end(path)
+                if path in self.disk:
+                    self.disk.move_to_end(path)
+                self.hits += 1
+                return data
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.misses += 1
+            if path not in self.disk:
+                self.disk[path] = len(data)
+                self.disk_bytes += len(data)
+            self.disk.move_to_end(path)
+            if len(data) <= self.memory_limit and path not in self.memory:
+                self.memory[path] = data
+                self.memory_bytes += len(data)
+                while self.memory_bytes > self.memory_limit:
+                    _, evicted = self.memory.popitem(last=False)
+                    self.memory_bytes -= len(evicted)
+        return data
+
+    def evict(self, pinned):
+        """Remove the least recently used segments from disk until the cache fits, skipping `pinned` paths."""
+        removed = []
+        with self.lock:
+            for path in list(self.disk):
+                if self.disk_bytes <= self.disk_limit:
+                    break
+                if path in pinned:
+                    continue
+                self.disk_bytes -= self.disk.pop(path)
+                data = self.memory.pop(path, None)
+                if data is not None:
+                    self.memory_bytes -= len(data)
+                removed.append(path)
+            self.evictions += len(removed)
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def forget(self, prefix):
+        """Drop every cached segment under a directory."""
+        with self.lock:
+            for path in [path for path in self.disk if path.startswith(prefix)]:
+                self.disk_bytes -= self.disk.pop(path)
+            for path in [path for path in self.memory if path.startswith(prefix)]:
+                self.memory_bytes -= len(self.memory.pop(path))
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'memory_bytes': self.memory_bytes,
+                'memory_segments': len(self.memory),
+                'disk_bytes': self.disk_bytes,
+                'disk_segments': len(self.disk),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class HlsStream:
+    """One ffmpeg process segmenting a source URL into an HLS playlist on disk."""
+
+    def __init__(self, stream_id, url):
+        self.stream_id = stream_id
+        self.url = url
+        self.directory = os.path.join(hls_dir, stream_id)
+        self.process = None
+        self.lock = threading.Lock()
+        self.last_request = time.time()
+        self.started_at = None
+        self.restarts = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def playlist_path(self):
+        return os.path.join(self.directory, PLAYLIST_NAME)
+
+    def ffmpeg_command(self):
+        return [
+            'ffmpeg', '-i', self.url,
+            '-c:v', 'copy', '-c:a', 'aac',  # Use AAC for audio
+            '-b:a', '128k',  # Set audio bitrate
+            '-f', 'hls',
+            '-hls_time', str(segment_seconds),
+            '-hls_list_size', str(playlist_size),
+            # Keep the old segments around for the cache and continue the playlist after a restart, temp_file writes
+            # each segment as .ts.tmp and renames it once complete, so a .ts file is never read half written
+            '-hls_flags', 'append_list+omit_endlist+independent_segments+temp_file',
+            '-hls_segment_filename', os.path.join(self.directory, 'segment_%06d.ts'),
+            self.playlist_path
+        ]
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ensure_running(self):
+        """Start ffmpeg unless it is already running, also marks the stream as in use."""
+        self.last_request = time.time()
+        with self.lock:
+            if self.is_running():
+                return
+            if self.process is not None:
+                self.restarts += 1
+            logger.info(f"Starting HLS ffmpeg for stream {self.stream_id}")
+            self.process = subprocess.Popen(self.ffmpeg_command(), stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+            self.started_at = time.time()
+
+    def stop(self):
+        with self.lock:
+            if self.is_running():
+                logger.info(f"Stopping HLS ffmpeg for stream {self.stream_id}")
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+
+    def playlist_segments(self):
+        """Paths of the segments referenced by the current playlist."""
+        try:
+            with open(self.playlist_path) as file:
+                return {os.path.join(self.directory, line.strip()) for line in file
+                        if line.strip() and not line.startswith('#')}
+        except FileNotFoundError:
+            return set()
+
+    def scan(self, cache):
+        """Register the segments ffmpeg wrote since the last scan."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.ts'):
+                    cache.track(entry.path, entry.stat().st_size)
+
+    def metrics(self):
+        return {
+            'stream_id': self.stream_id,
+            'url': self.url,
+            'running': self.is_running(),
+            'restarts': self.restarts,
+            'seconds_since_last_request': round(time.time() - self.last_request, 1),
+            'playlist_segments': len(self.playlist_segments()),
+        }
+
+
+class HlsManager:
+    """Keeps one HlsStream per stream id, stops idle ffmpeg processes and bounds the segment cache."""
+
+    def __init__(self):
+        self.streams = {}
+        self.cache = SegmentCache(memory_cache_bytes, disk_cache_bytes)
+        self.lock = threading.Lock()
+        self._reaper = None
+
+    def get_or_start(self, stream_id, url):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                stream = HlsStream(stream_id, url)
+                self.streams[stream_id] = stream
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name='hls-reaper', daemon=True)
+                self._reaper.start()
+        stream.ensure_running()
+        return stream
+
+    def get(self, stream_id):
+        with self.lock:
+            return self.streams.get(stream_id)
+
+    def _reap(self):
+        while True:
+            time.sleep(segment_seconds / 2)
+            with self.lock:
+                streams = list(self.streams.values())
+            pinned = set()
+            for stream in streams:
+                if stream.is_running() and time.time() - stream.last_request > idle_timeout:
+                    stream.stop()
+                try:
+                    stream.scan(self.cache)
+                except FileNotFoundError:
+                    continue
+                if stream.is_running():
+                    pinned |= stream.playlist_segments()
+            self.cache.evict(pinned)
+
+    def wait_for_playlist(self, stream, timeout):
+        """Wait until ffmpeg wrote the first playlist, returns False if it did not within `timeout`."""
+        deadline = time.time() + timeout
+        while not os.path.exists(stream.playlist_path):
+            if time.time() > deadline or not stream.is_running():
+                return False
+            time.sleep(0.2)
+        return True
+
+    def remove(self, stream_id):
+        """Stop a stream and delete its cached segments."""
+        with self.lock:
+            stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return False
+        stream.stop()
+        self.cache.forget(stream.directory + os.sep)
+        shutil.rmtree(stream.directory, ignore_errors=True)
+        return True
+
+    def metrics(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        return {'streams': [stream.metrics() for stream in streams], 'cache': self.cache.metrics()}
+
+
+hls_streams = HlsManager()
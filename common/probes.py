@@ -0,0 +1,171 @@
+import asyncio
+import ipaddress
+import logging
+import math
+import os
+import socket
+import struct
+import time
+from collections import deque
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# The internal-net services of docker-compose.yml and the HTTP proxy of gluetun (docker-compose-vpn.yml),
+# peer nodes are added with PROBE_TARGETS (which replaces this list)
+default_targets = ('mariadb=172.20.0.2:3306,redis=172.20.0.3:6379,server_setup=172.20.0.4:5000,'
+                   'filebrowser=172.20.0.5:80,gluetun=172.20.0.6:8888')
+probe_timeout = float(os.getenv('PROBE_TIMEOUT', '2'))
+# Number of rounds the percentiles, jitter and loss are computed over
+probe_window = int(os.getenv('PROBE_WINDOW', '30'))
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+class Target:
+    """
+    One probe target, parsed from `[name=]host:port` (TCP connect) or `[name=]host` (ICMP echo).
+    """
+
+    def __init__(self, spec):
+        name, _, address = spec.strip().rpartition('=')
+        host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+        self.host = host
+        self.port = int(port) if port else None
+        self.kind = 'tcp' if self.port else 'icmp'
+        self.name = name or address
+        self.rtts = deque(maxlen=probe_window)  # Seconds, None for a lost probe
+        self.last_error = None
+
+
+def parse_targets(value):
+    return [Target(spec) for spec in value.split(',') if spec.strip()]
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of an already sorted list."""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(target):
+    """
+    Rolling statistics of a target over the probe window.
+
+    Returns:
+        dict: RTT percentiles and jitter in seconds (None without any reply) and the loss in percent.
+    """
+    samples = list(target.rtts)
+    replies = [rtt for rtt in samples if rtt is not None]
+    ordered = sorted(replies)
+    return {
+        'name': target.name,
+        'host': target.host,
+        'port': target.port,
+        'kind': target.kind,
+        'samples': len(samples),
+        'loss_percent': (len(samples) - len(replies)) / len(samples) * 100 if samples else None,
+        'last_rtt': samples[-1] if samples else None,
+        'rtt_min': ordered[0] if ordered else None,
+        'rtt_p50': percentile(ordered, 0.5) if ordered else None,
+        'rtt_p90': percentile(ordered, 0.9) if ordered else None,
+        'rtt_p99': percentile(ordered, 0.99) if ordered else None,
+        'rtt_max': ordered[-1] if ordered else None,
+        # Mean difference between consecutive replies, as in RFC 3550 but without the smoothing
+        'jitter': (sum(abs(b - a) for a, b in zip(replies, replies[1:])) / (len(replies) - 1)
+                   if len(replies) > 1 else None),
+        'last_error': target.last_error,
+    }
+
+
+async def _resolve(loop, host):
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        infos = await loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return infos[0][4][0]
+
+
+async def probe_tcp(loop, host, port, timeout):
+    """
+    Time a TCP handshake. A refused connection still proves a remote host answered, but on a loopback address
+    it is our own kernel answering for a service that is down, so it counts as lost.
+    """
+    address = await _resolve(loop, host)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (address, port)), timeout)
+        except ConnectionRefusedError:
+            if ipaddress.ip_address(address).is_loopback:
+                raise
+        return time.perf_counter() - started
+    finally:
+        sock.close()
+
+
+def icmp_permitted():
+    """Unprivileged ICMP sockets need the group of the process in net.ipv4.ping_group_range."""
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+        return True
+    except OSError:
+        return False
+
+
+async def probe_icmp(loop, host, timeout, sequence):
+    """Time an ICMP echo over an unprivileged datagram socket, the kernel sets the identifier and checksum."""
+    address = await _resolve(loop, host)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    sock.setblocking(False)
+    reply = loop.create_future()
+
+    def on_readable():
+        try:
+            packet = sock.recv(1024)
+        except OSError as e:
+            if not reply.done():
+                reply.set_exception(e)
+            return
+        icmp_type, _, _, _, reply_sequence = struct.unpack('!BBHHH', packet[:8])
+        if icmp_type == ICMP_ECHO_REPLY and reply_sequence == sequence and not reply.done():
+            reply.set_result(time.perf_counter())
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        started = time.perf_counter()
+        sock.sendto(struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, sequence) + b'server_setup', (address, 0))
+        return await asyncio.wait_for(reply, timeout) - started
+    finally:
+        loop.remove_reader(sock.fileno())
+        sock.close()
+
+
+async def probe_all(targets, timeout, icmp=True, sequence=0):
+    """
+    Probe every target once, all concurrently on the running event loop.
+
+    Each target gets its RTT (or None when lost) appended to its window.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def probe(target):
+        try:
+            if target.kind == 'tcp':
+                rtt = await probe_tcp(loop, target.host, target.port, timeout)
+            elif icmp:
+                rtt = await probe_icmp(loop, target.host, timeout, sequence)
+            else:
+                target.last_error = 'ICMP is not permitted for this user'
+                return
+            target.last_error = None
+        except asyncio.TimeoutError:
+            rtt, target.last_error = None, f'no reply within {timeout}s'
+        except OSError as e:
+            rtt, target.last_error = None, str(e)
+        target.rtts.append(rtt)
+
+    await asyncio.gather(*(probe(target) for target in targets))
@@ -0,0 +1,117 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# Edits to the working tree do not touch any ref, so the dirty flag is also refreshed after this many seconds
+status_ttl = float(os.getenv('PROJECT_STATUS_TTL', '30'))
+max_workers = int(os.getenv('PROJECT_STATUS_WORKERS', '8'))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def ref_signature(repo_path):
+    """
+    Modification times of the files a `git status --branch` result depends on.
+
+    A commit, checkout, fetch, pull or `git add` changes at least one of them.
+    """
+    git_dir = os.path.join(repo_path, '.git')
+    signature = [_mtime(os.path.join(git_dir, name)) for name in ('HEAD', 'index', 'packed-refs', 'FETCH_HEAD')]
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as file:
+            head = file.read().strip()
+    except OSError:
+        return tuple(signature)
+    if head.startswith('ref: '):
+        ref = head[5:]
+        signature.append(_mtime(os.path.join(git_dir, ref)))
+        signature.append(_mtime(os.path.join(git_dir, ref.replace('refs/heads/', 'refs/remotes/origin/', 1))))
+    return tuple(signature)
+
+
+def git_status(repo_path):
+    """
+    Read branch, HEAD, upstream, ahead/behind and dirty state with a single `git status` call.
+
+    Ahead/behind compare against the last fetched upstream, this never touches the network.
+
+    Returns:
+        dict: The working copy status.
+    """
+    result = subprocess.run(
+        # --no-optional-locks keeps status from rewriting the index, which would invalidate our own cache
+        ['git', '--no-optional-locks', '-c', 'safe.directory=*', '-C', repo_path, 'status', '--porcelain=v2',
+         '--branch'],
+        capture_output=True, text=True, timeout=30)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip()}
+
+    status = {'branch': None, 'head': None, 'upstream': None, 'ahead': 0, 'behind': 0, 'dirty': False,
+              'changed_files': 0}
+    for line in result.stdout.splitlines():
+        if line.startswith('# branch.oid '):
+            oid = line.split(' ', 2)[2]
+            status['head'] = None if oid == '(initial)' else oid
+        elif line.startswith('# branch.head '):
+            head = line.split(' ', 2)[2]
+            status['branch'] = None if head == '(detached)' else head
+        elif line.startswith('# branch.upstream '):
+            status['upstream'] = line.split(' ', 2)[2]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line.split(' ')[2:4]
+            status['ahead'], status['behind'] = int(ahead), -int(behind)
+        elif line and not line.startswith('#'):
+            status['changed_files'] += 1
+    status['dirty'] = status['changed_files'] > 0
+    return status
+
+
+class ProjectStatus:
+    """Status of every git working copy under a directory, computed concurrently and cached per repository."""
+
+    def __init__(self, root):
+        self.root = root
+        self.cache = {}  # path -> (signature, checked_at, status)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='git-status')
+
+    def _status(self, path):
+        signature = ref_signature(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and cached[0] == signature and time.time() - cached[1] < status_ttl:
+            return cached[2]
+        try:
+            status = git_status(path)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            status = {'error': str(e)}
+        with self.lock:
+            self.cache[path] = (signature, time.time(), status)
+        return status
+
+    def list(self):
+        """
+        Return the status of every project folder.
+
+        Returns:
+            list: One entry per folder under the root, sorted by name.
+        """
+        try:
+            names = sorted(entry.name for entry in os.scandir(self.root)
+                           if entry.is_dir() and os.path.isdir(os.path.join(entry.path, '.git')))
+        except FileNotFoundError:
+            return []
+        paths = [os.path.join(self.root, name) for name in names]
+        statuses = self.executor.map(self._status, paths)
+        return [{'name': name, **status} for name, status in zip(names, statuses)]
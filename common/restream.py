@@ -0,0 +1,286 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# Get the logger for this module
+logger = logging.getLogger(__name__)
+
+# MPEG-TS packets are 188 bytes, reading whole packets keeps every chunk (and so every viewer) aligned
+TS_PACKET_SIZE = 188
+chunk_size = TS_PACKET_SIZE * 348  # ~64KB
+
+buffer_chunks = int(os.getenv('RESTREAM_BUFFER_MB', '16')) * 1024 * 1024 // chunk_size
+prebuffer_chunks = int(os.getenv('RESTREAM_PREBUFFER_KB', '512')) * 1024 // chunk_size
+idle_timeout = float(os.getenv('RESTREAM_IDLE_TIMEOUT', '10'))
+stall_timeout = float(os.getenv('RESTREAM_STALL_TIMEOUT', '10'))
+
+
+class SlowClient(Exception):
+    """Raised when a viewer fell so far behind that its next chunk was already dropped from the ring."""
+
+
+class ChunkRing:
+    """
+    Fixed size ring of chunks shared by all the viewers of a stream.
+
+    The writer appends at `head` (an absolute chunk number that only grows) and every viewer keeps its
+    own absolute cursor. Chunks are immutable bytes handed to every viewer as is, so fanning out to
+    another viewer costs no copy and no extra memory. WSGI servers only accept bytes, which is why
+    this shares whole chunks instead of memoryview slices of a single bytearray.
+    """
+
+    def __init__(self, slots):
+        self.slots = [None] * slots
+        self.head = 0
+        self.bytes_in = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def append(self, chunk):
+        with self.condition:
+            self.slots[self.head % len(self.slots)] = chunk
+            self.head += 1
+            self.bytes_in += len(chunk)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def start_position(self, prebuffer):
+        """Position a new viewer starts from, a little behind the head so players can start quickly."""
+        with self.condition:
+            return max(0, self.head - prebuffer, self.head - len(self.slots) + 1)
+
+    def read(self, cursor, timeout):
+        """
+        Wait for the chunk at `cursor`.
+
+        Returns:
+            bytes: The chunk, or None on timeout or when the ring is closed.
+
+        Raises:
+            SlowClient: If the chunk was already overwritten.
+        """
+        with self.condition:
+            if self.head <= cursor and not self.closed:
+                self.condition.wait(timeout)
+            if cursor < self.head - len(self.slots):
+                raise SlowClient(f"viewer at chunk {cursor} fell behind the writer at chunk {self.head}")
+            if cursor >= self.head:
+                return None
+            return self.slots[cursor % len(self.slots)]
+
+
+class Viewer:
+    def __init__(self, name, cursor):
+        self.name = name
+        self.cursor = cursor
+        self.connected_at = time.time()
+        self.bytes_sent = 0
+        self.active = True
+
+
+class Stream:
+    """One ffmpeg process for a source URL, fanned out to any number of viewers."""
+
+    def __init__(self, stream_id, url):
+        self.stream_id = stream_id
+        self.url = url
+        self.ring = ChunkRing(buffer_chunks)
+        self.viewers = {}
+        self.lock = threading.Lock()
+        self.process = None
+        self.stopped = False
+        self.started_at = time.time()
+        self.last_chunk_time = time.time()
+        self.idle_since = time.time()
+        self.restarts = 0
+        self.evicted = 0
+        self.total_viewers = 0
+
+    def ffmpeg_command(self):
+        return [
+            'ffmpeg', '-re', '-i', self.url,
+            '-c:v', 'copy', '-c:a', 'aac',  # Use AAC for audio
+            '-b:a', '128k',  # Set audio bitrate
+            '-f', 'mpegts',
+            '-fflags', 'nobuffer',
+            '-flush_packets', '1',
+            'pipe:1'
+        ]
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'restream-{self.stream_id}', daemon=True).start()
+
+    def _run(self):
+        """Run ffmpeg and copy its output into the ring, restarting it with a backoff until the stream is stopped."""
+        backoff = 1
+        while not self.stopped:
+            self.process = subprocess.Popen(self.ffmpeg_command(), stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE, bufsize=chunk_size)
+            threading.Thread(target=self._log_errors, args=(self.process,), daemon=True).start()
+            try:
+                while not self.stopped:
+                    chunk = self.process.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    self.ring.append(chunk)
+                    self.last_chunk_time = time.time()
+                    backoff = 1
+            except (OSError, ValueError) as e:
+                logger.error(f"Error while reading stream {self.stream_id}: {e}")
+            finally:
+                self._kill()
+
+            if not self.stopped:
+                self.restarts += 1
+                logger.info(f"Source stream ended for {self.stream_id}, restarting ffmpeg in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+        self.ring.close()
+        logger.info(f"Stream {self.stream_id} fully terminated.")
+
+    def _log_errors(self, process):
+        for line in process.stderr:
+            if b'error' in line.lower():
+                logger.error(f"FFmpeg error in stream {self.stream_id}: {line.decode(errors='replace').strip()}")
+
+    def _kill(self):
+        process = self.process
+        if process and process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def stop(self):
+        logger.info(f"Cleaning up stream {self.stream_id}")
+        self.stopped = True
+        self._kill()
+        self.ring.close()
+
+    def check_health(self):
+        """Restart ffmpeg if it stopped producing data, stop the stream once nobody watched it for a while."""
+        with self.lock:
+            idle = not self.viewers and time.time() - self.idle_since > idle_timeout
+        if idle:
+            logger.info(f"No more clients active. Stopping stream {self.stream_id}")
+            self.stop()
+        elif time.time() - self.last_chunk_time > stall_timeout:
+            logger.warning(f"Stream {self.stream_id} timed out. Restarting.")
+            self.last_chunk_time = time.time()
+            self._kill()
+
+    def attach(self, name):
+        viewer = Viewer(name, self.ring.start_position(prebuffer_chunks))
+        with self.lock:
+            previous = self.viewers.get(name)
+            if previous:
+                # A reconnect from the same user replaces the old connection
+                previous.active = False
+            self.viewers[name] = viewer
+            self.total_viewers += 1
+        return viewer
+
+    def detach(self, viewer, evicted=False):
+        with self.lock:
+            viewer.active = False
+            if self.viewers.get(viewer.name) is viewer:
+                del self.viewers[viewer.name]
+            if evicted:
+                self.evicted += 1
+            if not self.viewers:
+                self.idle_since = time.time()
+
+    def iter_viewer(self, viewer):
+        """Yield the stream data for a viewer until it disconnects, is replaced or is evicted."""
+        evicted = False
+        try:
+            while viewer.active and not self.stopped:
+                chunk = self.ring.read(viewer.cursor, timeout=1)
+                if chunk is None:
+                    continue
+                viewer.cursor += 1
+                viewer.bytes_sent += len(chunk)
+                yield chunk
+        except SlowClient as e:
+            logger.info(f"Evicting slow client {viewer.name} from stream {self.stream_id}: {e}")
+            evicted = True
+        finally:
+            if viewer.active and not evicted:
+                logger.info(f"Client {viewer.name} disconnected from stream {self.stream_id}")
+            self.detach(viewer, evicted)
+
+    def metrics(self):
+        head = self.ring.head
+        with self.lock:
+            viewers = [{
+                'name': viewer.name,
+                'connected_seconds': round(time.time() - viewer.connected_at, 1),
+                'bytes_sent': viewer.bytes_sent,
+                'lag_chunks': head - viewer.cursor,
+            } for viewer in self.viewers.values()]
+        return {
+            'stream_id': self.stream_id,
+            'url': self.url,
+            'running': self.process is not None and self.process.poll() is None,
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'bytes_in': self.ring.bytes_in,
+            'buffer_bytes': len(self.ring.slots) * chunk_size,
+            'seconds_since_last_chunk': round(time.time() - self.last_chunk_time, 1),
+            'restarts': self.restarts,
+            'evicted_clients': self.evicted,
+            'total_clients': self.total_viewers,
+            'clients': viewers,
+        }
+
+
+class RestreamManager:
+    """Keeps one Stream per stream id and stops the ones nobody is watching."""
+
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+        self._reaper = None
+
+    def get_or_start(self, stream_id, url):
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None or stream.stopped:
+                logger.info(f"Starting ffmpeg for stream {stream_id}")
+                stream = Stream(stream_id, url)
+                self.streams[stream_id] = stream
+                stream.start()
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name='restream-reaper', daemon=True)
+                self._reaper.start()
+            return stream
+
+    def _reap(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                streams = list(self.streams.items())
+            for stream_id, stream in streams:
+                stream.check_health()
+                if stream.stopped:
+                    with self.lock:
+                        if self.streams.get(stream_id) is stream:
+                            del self.streams[stream_id]
+
+    def stop(self, stream_id):
+        with self.lock:
+            stream = self.streams.pop(stream_id, None)
+        if stream:
+            stream.stop()
+        return stream is not None
+
+    def metrics(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        return [stream.metrics() for stream in streams]
+
+
+restreams = RestreamManager()
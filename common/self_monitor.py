@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Default resource budget of the monitoring processes, small Tunnel/Proxy nodes can lower these in the .env
+cpu_budget_percent = float(os.getenv('MONITOR_CPU_BUDGET_PERCENT', '5'))
+rss_budget_mb = float(os.getenv('MONITOR_RSS_BUDGET_MB', '150'))
+
+
+class SelfMonitor:
+    """
+    Tracks the resource usage of the current process and the timing of its sampling loop.
+
+    When the process goes over its CPU or memory budget the loop interval is doubled (up to max_interval),
+    and if it is still over budget at the maximum interval the expensive collectors are switched off.
+    Once usage drops below half of the budget the interval is halved back towards the base interval
+    and the expensive collectors are switched on again.
+    """
+
+    def __init__(self, base_interval, max_interval=None, cpu_budget=None, rss_budget=None):
+        self.base_interval = base_interval
+        self.max_interval = max_interval or base_interval * 8
+        self.cpu_budget = cpu_budget if cpu_budget is not None else cpu_budget_percent
+        self.rss_budget = int((rss_budget if rss_budget is not None else rss_budget_mb) * 1024 * 1024)
+        self.interval = base_interval
+        self.expensive_enabled = True
+
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self._last_cpu_time = self._cpu_time()
+        self._last_cpu_check = time.monotonic()
+        self._cpu_percent = 0.0
+        self._scheduled = None
+        self._iteration_start = None
+        self.iterations = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _cpu_time(self):
+        cpu_times = self.process.cpu_times()
+        return cpu_times.user + cpu_times.system
+
+    def _update_cpu_percent(self):
+        now = time.monotonic()
+        cpu_time = self._cpu_time()
+        elapsed = now - self._last_cpu_check
+        if elapsed > 0:
+            self._cpu_percent = (cpu_time - self._last_cpu_time) / elapsed * 100
+        self._last_cpu_time, self._last_cpu_check = cpu_time, now
+        return self._cpu_percent
+
+    def start_iteration(self):
+        """Mark the start of a loop iteration and record how late it started compared to its schedule."""
+        now = time.monotonic()
+        with self.lock:
+            if self._scheduled is not None:
+                self.last_lag = max(0.0, now - self._scheduled)
+                self.max_lag = max(self.max_lag, self.last_lag)
+            else:
+                self._scheduled = now
+                # Measure the CPU from the first tick, the imports and setup before it are not the loop's usage
+                self._last_cpu_time, self._last_cpu_check = self._cpu_time(), now
+            self._iteration_start = now
+
+    def end_iteration(self):
+        """Mark the end of a loop iteration, check the budget and schedule the next tick."""
+        now = time.monotonic()
+        with self.lock:
+            self.iterations += 1
+            self.last_duration = now - self._iteration_start
+            self.max_duration = max(self.max_duration, self.last_duration)
+        self.check_budget()
+        with self.lock:
+            # Keep a fixed cadence, but never try to catch up on ticks that were missed
+            self._scheduled = max(self._scheduled + self.interval, now)
+
+    def wait(self):
+        """Sleep until the next scheduled tick."""
+        if self._scheduled is None:
+            return
+        time.sleep(max(0.0, self._scheduled - time.monotonic()))
+
+    def over_budget(self):
+        cpu_percent = self._update_cpu_percent()
+        rss = self.process.memory_info().rss
+        return cpu_percent > self.cpu_budget or rss > self.rss_budget, cpu_percent, rss
+
+    def check_budget(self):
+        """Lengthen or shorten the interval and toggle the expensive collectors based on the budget."""
+        over, cpu_percent, rss = self.over_budget()
+        with self.lock:
+            if over:
+                if self.interval < self.max_interval:
+                    self.interval = min(self.interval * 2, self.max_interval)
+                    logger.warning(f"Monitor over budget (cpu {cpu_percent:.1f}%, rss {rss}), "
+                                   f"interval raised to {self.interval}s")
+                elif self.expensive_enabled:
+                    self.expensive_enabled = False
+                    logger.warning("Monitor still over budget at the maximum interval, expensive collectors disabled")
+            elif cpu_percent < self.cpu_budget / 2 and rss < self.rss_budget:
+                if not self.expensive_enabled:
+                    self.expensive_enabled = True
+                    logger.info("Monitor back under budget, expensive collectors enabled")
+                elif self.interval > self.base_interval:
+                    self.interval = max(self.interval / 2, self.base_interval)
+                    logger.info(f"Monitor back under budget, interval lowered to {self.interval}s")
+
+    def snapshot(self):
+        """
+        Return the resource usage of this process and the loop timings.
+
+        Returns:
+            dict: Raw numbers (seconds, bytes, percent) describing the process and its sampling loop.
+        """
+        with self.process.oneshot():
+            cpu_times = self.process.cpu_times()
+            memory = self.process.memory_info()
+            num_threads = self.process.num_threads()
+            try:
+                num_fds = self.process.num_fds()
+            except (AttributeError, psutil.Error):
+                num_fds = None
+        with self.lock:
+            return {
+                'pid': self.process.pid,
+                'uptime_seconds': round(time.time() - self.started_at, 1),
+                'cpu_user_seconds': cpu_times.user,
+                'cpu_system_seconds': cpu_times.system,
+                'cpu_percent': round(self._cpu_percent, 2),
+                'rss_bytes': memory.rss,
+                'num_threads': num_threads,
+                'num_fds': num_fds,
+                'iterations': self.iterations,
+                'last_iteration_seconds': round(self.last_duration, 4),
+                'max_iteration_seconds': round(self.max_duration, 4),
+                'last_lag_seconds': round(self.last_lag, 4),
+                'max_lag_seconds': round(self.max_lag, 4),
+                'interval_seconds': self.interval,
+                'expensive_enabled': self.expensive_enabled,
+                'budget': {'cpu_percent': self.cpu_budget, 'rss_bytes': self.rss_budget},
+            }
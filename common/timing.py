@@ -0,0 +1,159 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+from flask import Response, g, has_request_context, request
+
+# Timing is cheap enough to leave on; the sampling profiler must be opted into explicitly
+timing_enabled = os.getenv('ENABLE_REQUEST_TIMING', 'true').lower() == 'true'
+profiling_enabled = os.getenv('ENABLE_PROFILING', 'false').lower() == 'true'
+profile_interval = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000
+
+# Upper bounds (in milliseconds) of the histogram buckets, the last one catches everything else
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_NULL_SPAN = nullcontext()
+_histograms = defaultdict(lambda: {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * len(BUCKETS_MS)})
+_histograms_lock = threading.Lock()
+
+
+def _record(endpoint, phase, duration_ms):
+    with _histograms_lock:
+        hist = _histograms[(endpoint, phase)]
+        hist['count'] += 1
+        hist['sum_ms'] += duration_ms
+        hist['max_ms'] = max(hist['max_ms'], duration_ms)
+        hist['buckets'][bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+
+
+@contextmanager
+def _timed_span(name):
+    # Each entry on the stack tracks the time spent in nested spans, so a span only
+    # reports its own (exclusive) time and phases add up to the request total.
+    stack = g._timing_stack
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        child_time = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        g._timing_spans[name] += elapsed - child_time
+
+
+def span(name):
+    """
+    Time a phase of the current request (e.g. docker, psutil, file, marshal).
+
+    Args:
+        name (str): The phase name, reported in Server-Timing and /monitor/debug/timings.
+
+    Returns:
+        A context manager; a shared no-op one when timing is disabled or outside a request.
+    """
+    if not timing_enabled or not has_request_context() or not hasattr(g, '_timing_spans'):
+        return _NULL_SPAN
+    return _timed_span(name)
+
+
+class StackSampler:
+    """Samples the stack of a single thread and aggregates it in folded (flamegraph) format."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+
+def _before_request():
+    if timing_enabled:
+        g._timing_start = time.perf_counter()
+        g._timing_stack = []
+        g._timing_spans = defaultdict(float)
+    if profiling_enabled and request.args.get('profile') == '1':
+        g._profiler = StackSampler(threading.get_ident(), profile_interval)
+        g._profiler.start()
+
+
+def _after_request(response):
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        return Response(profiler.folded(), mimetype='text/plain')
+
+    if not timing_enabled or not hasattr(g, '_timing_start'):
+        return response
+
+    total_ms = (time.perf_counter() - g._timing_start) * 1000
+    endpoint = request.endpoint or 'unknown'
+    phases = {name: seconds * 1000 for name, seconds in g._timing_spans.items()}
+    for name, duration_ms in phases.items():
+        _record(endpoint, name, duration_ms)
+    _record(endpoint, 'total', total_ms)
+
+    entries = [f"{name};dur={duration_ms:.2f}" for name, duration_ms in phases.items()]
+    entries.append(f"total;dur={total_ms:.2f}")
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def init_app(app):
+    """Register the timing and profiling hooks on the Flask application."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def get_timings():
+    """
+    Return the aggregated timing histograms.
+
+    Returns:
+        dict: Per endpoint, per phase count, sum, mean, max and bucket counts in milliseconds.
+    """
+    labels = [f"le_{bound}" if bound != float('inf') else 'le_inf' for bound in BUCKETS_MS]
+    result = defaultdict(dict)
+    with _histograms_lock:
+        for (endpoint, phase), hist in _histograms.items():
+            result[endpoint][phase] = {
+                'count': hist['count'],
+                'sum_ms': round(hist['sum_ms'], 3),
+                'mean_ms': round(hist['sum_ms'] / hist['count'], 3) if hist['count'] else 0.0,
+                'max_ms': round(hist['max_ms'], 3),
+                'buckets': dict(zip(labels, hist['buckets'])),
+            }
+    return dict(result)
+
+
+def reset_timings():
+    with _histograms_lock:
+        _histograms.clear()
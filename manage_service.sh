@@ -2,7 +2,11 @@
 # chmod +x manage_service.sh
 FOLDER_NAME=$1
 OPERATION=$2
+# Pass "force" as the third argument to rebuild even when nothing changed
+FORCE=$3
 SERVICE_DIRECTORY="$HOME/$FOLDER_NAME"
+GIT_REMOTE=${GIT_REMOTE:-origin}
+GIT_BRANCH=${GIT_BRANCH:-main}
 
 if [ ! -d "$SERVICE_DIRECTORY" ]; then
     echo "Directory $SERVICE_DIRECTORY does not exist."
@@ -18,6 +22,32 @@ cd $SERVICE_DIRECTORY
 
 echo "After the PWD is : ${PWD}"
 
+# Where the build context hash of the last successful build is kept, inside .git so it never shows up as a change
+LAST_BUILD_FILE="$(git rev-parse --git-dir)/last_build_$FOLDER_NAME"
+
+# Fetch once and fast-forward only when the remote moved, prints whether anything changed
+sync_with_remote() {
+    git fetch --quiet "$GIT_REMOTE" "$GIT_BRANCH" || return 1
+    local local_head remote_head
+    local_head=$(git rev-parse HEAD)
+    remote_head=$(git rev-parse FETCH_HEAD)
+    if [ "$local_head" = "$remote_head" ]; then
+        echo "Already at $local_head, nothing to pull."
+    else
+        echo "Updating $local_head -> $remote_head"
+        git merge --ff-only FETCH_HEAD || return 1
+    fi
+}
+
+# Hash of everything the image is built from: the committed tree plus any local and untracked changes
+build_context_hash() {
+    {
+        git rev-parse 'HEAD^{tree}'
+        git diff HEAD
+        git ls-files --others --exclude-standard -z | xargs -0 -r sha256sum
+    } | sha256sum | cut -d' ' -f1
+}
+
 case $OPERATION in
     stop)
         nohup docker-compose stop $FOLDER_NAME > /dev/null 2>&1 &
@@ -25,15 +55,27 @@ case $OPERATION in
     restart)
         nohup docker-compose restart $FOLDER_NAME > /dev/null 2>&1 &
         ;;
+    recreate)
+        # A restart keeps the old environment, recreating the container picks up a changed env_file
+        docker-compose up -d --no-deps --force-recreate $FOLDER_NAME
+        ;;
     start)
-        git pull origin main
+        sync_with_remote || exit 1
         nohup docker-compose up -d $FOLDER_NAME > /dev/null 2>&1 &
         ;;
     update)
-        git pull origin main
+        sync_with_remote || exit 1
+        CONTEXT_HASH=$(build_context_hash)
+        if [ "$FORCE" != "force" ] && [ -f "$LAST_BUILD_FILE" ] && [ "$(cat "$LAST_BUILD_FILE")" = "$CONTEXT_HASH" ] &&
+            [ -n "$(docker-compose ps -q $FOLDER_NAME 2>/dev/null)" ]; then
+            echo "Build context unchanged ($CONTEXT_HASH), skipping rebuild."
+            docker-compose up -d $FOLDER_NAME
+            exit $?
+        fi
         docker-compose build $FOLDER_NAME &&
         docker-compose rm -sf $FOLDER_NAME &&
-        docker-compose up -d $FOLDER_NAME
+        docker-compose up -d $FOLDER_NAME &&
+        echo "$CONTEXT_HASH" > "$LAST_BUILD_FILE"
         ;;
     *)
         echo "Invalid operation: $OPERATION"